@@ -9,9 +9,12 @@
         'security/pico_security.xml',
         'security/ir.model.access.csv',
         'data/activity_data.xml',
+        'data/ir_cron_data.xml',
         'views/mrp_views.xml',
         'views/pico_menu.xml',
         'views/pico_workflow_view.xml',
+        'views/pico_queue_views.xml',
+        'views/pico_archive_views.xml',
         'views/res_config_settings_views.xml',
     ],
     'auto_install': False,
@@ -1,3 +1,5 @@
+from json import dumps, loads
+
 from odoo import http
 
 from logging import getLogger
@@ -9,15 +11,39 @@ class PicoMESController(http.Controller):
     @http.route('/picoapi/webhook', methods=['POST'], type='json', auth='public')
     def picoapi_webhook(self, **data):
         jsonrequest = http.request.jsonrequest
-        id = data.get('id')
-        if not id or len(id) < 14:
+        webhook = http.request.env['pico.webhook'].sudo()
+        if not webhook._is_valid_call(data):
             return
 
         method = jsonrequest.get('method')
-        if method == 'newWorkflowVersionMethod':
-            http.request.env['pico.workflow'].sudo().process_pico_data(data)
-        elif method == 'workOrderCompleteMethod':
-            _logger.info(data)
-            http.request.env['mrp.production.pico.work.order'].sudo().pico_complete(data)
-        else:
-            raise Exception('Invalid method called. (01)')
+        rpc_id = jsonrequest.get('id')
+        if webhook._async_enabled():
+            delivery = http.request.env['pico.webhook.delivery'].sudo()
+            if delivery._is_processed(rpc_id, delivery._payload_hash(data)):
+                return
+            # acknowledge now, the queue cron will process it
+            http.request.env['pico.webhook.queue'].sudo().enqueue(method, data, rpc_id=rpc_id)
+            return
+        webhook._lock_calls([(method, data)])
+        webhook._dispatch_once(method, data, rpc_id)
+
+    @http.route('/picoapi/webhook/batch', methods=['POST'], type='http', auth='public', csrf=False)
+    def picoapi_webhook_batch(self, **kw):
+        """
+        JSON-RPC batch (array of calls) version of the webhook.
+        Odoo handles 'application/json' bodies as a single JSON-RPC call, so batches are posted
+        with another content type (e.g. 'text/plain').
+        """
+        try:
+            calls = loads(http.request.httprequest.get_data())
+        except ValueError:
+            return http.Response(status=400)
+        if isinstance(calls, dict):
+            calls = [calls]
+        if not isinstance(calls, list):
+            return http.Response(status=400)
+        webhook = http.request.env['pico.webhook'].sudo()
+        if not webhook._async_enabled():
+            webhook._lock_calls([(call.get('method'), call.get('params')) for call in calls if isinstance(call, dict)])
+        responses = webhook._dispatch_batch(calls)
+        return http.Response(dumps(responses), content_type='application/json')
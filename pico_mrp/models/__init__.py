@@ -1,3 +1,7 @@
 from . import pico_workflow
 from . import mrp
 from . import res_config_settings
+from . import pico_outbox
+from . import pico_webhook
+from . import pico_archive
+from . import pico_progress
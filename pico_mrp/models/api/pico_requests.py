@@ -1,10 +1,120 @@
 import requests
-from requests.exceptions import ConnectionError, HTTPError, InvalidSchema
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, InvalidSchema, Timeout
 from json import dumps
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
+
+# Sessions are kept per worker process, keyed by (url, customer_key, pool_size, keep_alive),
+# so that connections (and their TLS handshake) are re-used between requests.
+_sessions = {}
+_sessions_lock = Lock()
+
+
+def get_session(url, customer_key, pool_size=10, keep_alive=True):
+    key = (url, customer_key, pool_size, keep_alive)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if not keep_alive:
+                session.headers['Connection'] = 'close'
+            _sessions[key] = session
+        return session
+
+
+class PicoCircuitOpen(ConnectionError):
+    """ Raised without calling Pico while its circuit breaker is open. """
+
+
+class PicoCircuitBreaker:
+    """
+    Counts consecutive failed calls to one Pico endpoint.
+    After `failure_threshold` failures the breaker opens and calls fail fast, once `reset_timeout`
+    seconds have passed it is half open and lets calls through again, the first failure re-opens it.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = max(failure_threshold or 1, 1)
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def check(self):
+        if self.state == 'open':
+            raise PicoCircuitOpen('Pico is unavailable, calls are suspended for up to %ss' % (self.reset_timeout, ))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+
+    def reset(self):
+        self.record_success()
+
+
+# Breakers are kept per worker process and shared by every request to the same Pico endpoint.
+_breakers = {}
+
+
+def get_circuit_breaker(url, failure_threshold=5, reset_timeout=30.0):
+    with _sessions_lock:
+        breaker = _breakers.get(url)
+        if breaker is None:
+            breaker = _breakers[url] = PicoCircuitBreaker(failure_threshold, reset_timeout)
+        breaker.failure_threshold = max(failure_threshold or 1, 1)
+        breaker.reset_timeout = reset_timeout
+        return breaker
+
+
+class PicoMESDispatcher:
+    """
+    Runs API calls on a bounded thread pool, collecting the results in call order.
+    Calls must only do HTTP, the ORM is not thread safe and stays on the calling thread.
+    There is no overall timeout, each call is bounded by the timeout of its requests (and their retries).
+    """
+    def __init__(self, concurrency=4):
+        self.concurrency = max(concurrency or 1, 1)
+
+    def map(self, func, args_list, return_exceptions=False):
+        def call(args):
+            try:
+                return func(*args)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return e
+
+        if self.concurrency == 1 or len(args_list) <= 1:
+            return [call(args) for args in args_list]
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(args_list))) as executor:
+            futures = [executor.submit(call, args) for args in args_list]
+            return [future.result() for future in futures]
 
 
 class PicoMESRequest:
-    def __init__(self, url, customer_key):
+    def __init__(self, url, customer_key, batch_size=100, batch_endpoint=False,
+                 pool_size=10, keep_alive=True, timeout=30.0, concurrency=4,
+                 retries=3, backoff=0.5, failure_threshold=5, reset_timeout=30.0):
         self.url = url
         self.headers = {
             "Content-Type": "application/json",
@@ -12,17 +122,46 @@ class PicoMESRequest:
         }
         if customer_key:
             self.headers['x-pico-api-org'] = customer_key
+        self.session = get_session(url, customer_key, pool_size=pool_size, keep_alive=keep_alive)
+        self.timeout = timeout
+        self.batch_size = batch_size or 100
+        # When Pico does not offer the batch endpoint we fan out locally, one request per work order.
+        self.batch_endpoint = batch_endpoint
+        self.dispatcher = PicoMESDispatcher(concurrency=concurrency)
+        # Only idempotent calls are retried, a retried POST could create a work order twice.
+        self.retries = max(retries or 0, 0)
+        self.backoff = backoff
+        self.breaker = get_circuit_breaker(url, failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+
+    def request(self, method, endpoint, idempotent=False, **kwargs):
+        self.breaker.check()
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            try:
+                result = self.session.request(method, self.url + endpoint, headers=self.headers,
+                                              timeout=self.timeout, **kwargs)
+                if result.status_code >= 500:
+                    result.raise_for_status()
+            except (ConnectionError, Timeout, HTTPError):
+                self.breaker.record_failure()
+                if attempt + 1 >= attempts or self.breaker.state == 'open':
+                    raise
+                # exponential backoff with full jitter, so workers do not retry in lock step
+                sleep(uniform(0, self.backoff * 2 ** attempt))
+                continue
+            # Pico answered, a 4xx is an error in the call and not in Pico
+            self.breaker.record_success()
+            result.raise_for_status()
+            return result
 
     def post_request(self, endpoint, body):
-        url = self.url + endpoint
-        result = requests.post(url, headers=self.headers, data=dumps(body))
-        result.raise_for_status()
-        return result.json()
+        return self.request('POST', endpoint, data=dumps(body)).json()
+
+    def get_request(self, endpoint, params=None):
+        return self.request('GET', endpoint, idempotent=True, params=params).json()
 
     def delete_request(self, endpoint):
-        url = self.url + endpoint
-        result = requests.delete(url, headers=self.headers)
-        result.raise_for_status()
+        self.request('DELETE', endpoint, idempotent=True)
 
     def subscribe_jsonrpc(self, endpoint_url, new_workflow_version_method, work_order_complete_method):
         body = {
@@ -36,5 +175,64 @@ class PicoMESRequest:
         body = {"processId": process_id, 'workflowVersionId': workflow_version_id, 'annotation': annotation}
         return self.post_request('/work_orders', body)
 
+    def create_work_orders(self, work_orders, return_exceptions=False):
+        """
+        Create many work orders, sent concurrently (in batches of `batch_size` with the batch endpoint).
+        `work_orders` is a list of (process_id, workflow_version_id, annotation) tuples,
+        results are returned in the same order.
+        With `return_exceptions` a failed call gives its exception as the result of each of its work orders.
+        """
+        self.breaker.check()
+        if not self.batch_endpoint:
+            return self.dispatcher.map(self.create_work_order, work_orders, return_exceptions=return_exceptions)
+        batches = [(work_orders[i:i + self.batch_size], ) for i in range(0, len(work_orders), self.batch_size)]
+        results = []
+        for (batch, ), batch_results in zip(batches, self.dispatcher.map(self._create_work_orders_batch, batches,
+                                                                         return_exceptions=return_exceptions)):
+            if isinstance(batch_results, Exception):
+                results += [batch_results] * len(batch)
+            else:
+                results += batch_results
+        return results
+
+    def _create_work_orders_batch(self, work_orders):
+        body = {'workOrders': [{
+            'processId': process_id,
+            'workflowVersionId': workflow_version_id,
+            'annotation': annotation,
+        } for process_id, workflow_version_id, annotation in work_orders]}
+        return self.post_request('/work_orders/batch', body)
+
+    def get_work_order(self, work_order_id):
+        return self.get_request('/work_orders/' + work_order_id)
+
+    def get_work_orders(self, work_order_ids):
+        """
+        Status of many work orders (in batches of `batch_size` with the batch endpoint, else concurrently).
+        Returns a list in the order of work_order_ids with the work order, None when Pico did not return it,
+        or the exception raised when fetching it (or its batch).
+        """
+        self.breaker.check()
+        if not self.batch_endpoint:
+            return self.dispatcher.map(self.get_work_order, [(work_order_id, ) for work_order_id in work_order_ids],
+                                       return_exceptions=True)
+        batches = [(work_order_ids[i:i + self.batch_size], ) for i in range(0, len(work_order_ids), self.batch_size)]
+        work_orders = {}
+        for (batch, ), batch_results in zip(batches, self.dispatcher.map(self._get_work_orders_batch, batches,
+                                                                         return_exceptions=True)):
+            if isinstance(batch_results, Exception):
+                work_orders.update((work_order_id, batch_results) for work_order_id in batch)
+            else:
+                work_orders.update((work_order.get('id'), work_order) for work_order in batch_results)
+        return [work_orders.get(work_order_id) for work_order_id in work_order_ids]
+
+    def _get_work_orders_batch(self, work_order_ids):
+        return self.get_request('/work_orders', params={'ids': ','.join(work_order_ids)}).get('workOrders', [])
+
     def delete_work_order(self, work_order_id):
         return self.delete_request('/work_orders/' + work_order_id)
+
+    def delete_work_orders(self, work_order_ids, return_exceptions=False):
+        self.breaker.check()
+        return self.dispatcher.map(self.delete_work_order, [(work_order_id, ) for work_order_id in work_order_ids],
+                                   return_exceptions=return_exceptions)
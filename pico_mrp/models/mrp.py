@@ -1,10 +1,107 @@
+import threading
+from collections import Counter, deque
+from datetime import timedelta
+from json import dumps, loads
+from time import monotonic, sleep
+
 from odoo import api, models, fields, SUPERUSER_ID
+from odoo.tools.sql import index_exists
 
+from odoo.addons.pico_mrp.models.api.pico_requests import PicoCircuitOpen
 from odoo.addons.pico_mrp.models.pico_workflow import pico_api
 
 from logging import getLogger
 _logger = getLogger(__name__)
 
+
+def match_complete_sets(work_orders, process_ids):
+    """
+    Groups work orders into 'complete sets' having one work order for each of process_ids.
+    work_orders is an iterable of (work_order_id, process_id) in the order they should be used.
+    Returns a list of work order id lists, one for each complete set.
+    """
+    buckets = {process_id: deque() for process_id in process_ids}
+    if not buckets:
+        return []
+    for work_order_id, process_id in work_orders:
+        bucket = buckets.get(process_id)
+        if bucket is not None:
+            bucket.append(work_order_id)
+    set_count = min(len(bucket) for bucket in buckets.values())
+    return [[bucket.popleft() for bucket in buckets.values()] for _i in range(set_count)]
+
+# first key of the advisory locks serializing completions per production, 'PICO'
+PICO_PRODUCTION_LOCK = 0x5049434f
+
+
+def held_production_locks(cr):
+    # ids of the productions whose advisory lock is held by this connection
+    cr.execute("""
+        SELECT objid FROM pg_locks
+        WHERE locktype = 'advisory' AND pid = pg_backend_pid() AND classid = %s AND objsubid = 2
+    """, [PICO_PRODUCTION_LOCK])
+    return [row[0] for row in cr.fetchall()]
+
+
+def lock_productions(cr, production_ids):
+    """
+    Takes the session level advisory lock of each production not yet held by this connection.
+    Locks are taken in id order so that workers locking overlapping productions do not deadlock.
+    Returns the ids that were locked.
+    """
+    held = set(held_production_locks(cr))
+    locked = [production_id for production_id in sorted(set(production_ids)) if production_id not in held]
+    for production_id in locked:
+        cr.execute('SELECT pg_advisory_lock(%s, %s)', [PICO_PRODUCTION_LOCK, production_id])
+    return locked
+
+
+def try_lock_productions(cr, production_ids):
+    """
+    Like lock_productions() without waiting for productions locked by another connection.
+    Returns (the ids that were locked, the ids held by another connection).
+    """
+    held = set(held_production_locks(cr))
+    locked, busy = [], []
+    for production_id in sorted(set(production_ids)):
+        if production_id in held:
+            continue
+        cr.execute('SELECT pg_try_advisory_lock(%s, %s)', [PICO_PRODUCTION_LOCK, production_id])
+        (locked if cr.fetchone()[0] else busy).append(production_id)
+    return locked, busy
+
+
+def unlock_productions(cr, production_ids):
+    for production_id in production_ids:
+        cr.execute('SELECT pg_advisory_unlock(%s, %s)', [PICO_PRODUCTION_LOCK, production_id])
+
+
+def lock_productions_for_transaction(cr, production_ids):
+    """
+    Serializes completion processing per production, for the entry points (webhooks, crons) about to complete
+    work orders of production_ids. Concurrent completions wait here instead of failing with serialization
+    errors and being retried.
+    Under REPEATABLE READ a lock taken after the transaction's snapshot does not help (the snapshot misses
+    what the previous holder committed), so a session level lock is taken and the transaction committed,
+    the caller must invalidate its cache. The locks are released once the next transaction commits or rolls back.
+    Returns the ids that were locked.
+    """
+    locked = lock_productions(cr, production_ids)
+    if not locked:
+        return locked
+    try:
+        cr.commit()
+    except Exception:
+        unlock_productions(cr, locked)
+        raise
+
+    def unlock():
+        unlock_productions(cr, locked)
+    cr.after('commit', unlock)
+    cr.after('rollback', unlock)
+    return locked
+
+
 class MRPProduction(models.Model):
     # _inherit = ['mrp.production', 'mail.activity.mixin']
     _inherit = 'mrp.production'
@@ -12,17 +109,42 @@ class MRPProduction(models.Model):
     pico_process_id = fields.Many2one(related='bom_id.pico_process_id')
     pico_work_order_ids = fields.One2many('mrp.production.pico.work.order', 'production_id',
                                           string='Pico Work Orders')
+    pico_progress_ids = fields.One2many('mrp.production.pico.progress', 'production_id', string='Pico Progress',
+                                        readonly=True)
+    pico_released_qty = fields.Integer(string='Pico Released Units', copy=False, readonly=True)
+    # summary of the work orders moved to mrp.production.pico.work.order.archive
+    pico_archived_count = fields.Integer(string='Archived Pico Work Orders', copy=False, readonly=True)
+    pico_archived_cycle_time = fields.Integer(string='Archived Pico Cycle Time', copy=False, readonly=True)
+    pico_archived_date_complete = fields.Datetime(string='Last Archived Pico Completion', copy=False, readonly=True)
     no_finished_serial_err = ValueError('Process requires a finished serial, but none provided.')
 
-    def _pico_create_work_orders(self):
+    def _pico_create_work_orders(self, qty=None):
         model = self.env['mrp.production.pico.work.order'].sudo()
-        for i in range(int(self.product_qty)):
-            for p in self.pico_process_id.process_ids:
-                work_order = model.create({
-                    'production_id': self.id,
-                    'process_id': p.id,
-                })
-                work_order.pico_create()
+        processes = self.pico_process_id.process_ids
+        if qty is None:
+            qty = self._pico_release_qty()
+        work_orders = model.create([{
+            'production_id': self.id,
+            'process_id': p.id,
+        } for i in range(qty) for p in processes])
+        self.pico_released_qty += qty
+        work_orders.pico_create()
+
+    def _pico_release_qty(self):
+        # units to send to Pico now, only enough to keep the BoM's release window open when it has one
+        remaining_qty = int(self.product_qty) - self.pico_released_qty
+        window = self.bom_id.pico_release_window
+        if not window:
+            return max(remaining_qty, 0)
+        # every complete set has exactly one work order of the finished product's process
+        progress = self._pico_progress().get(self.pico_process_id.id)
+        completed_qty = progress.done_count if progress else 0
+        open_qty = self.pico_released_qty - completed_qty
+        return max(min(window - open_qty, remaining_qty), 0)
+
+    def _pico_progress(self):
+        # work order counters of the production by process id
+        return {progress.process_id.id: progress for progress in self.pico_progress_ids}
 
     def action_confirm(self):
         for production in self.filtered(lambda l: l.pico_process_id):
@@ -34,9 +156,8 @@ class MRPProduction(models.Model):
 
     def _pico_delete_work_orders(self):
         incomplete_work_orders = self.pico_work_order_ids.filtered(lambda wo: wo.state != "done")
-        for work_order in incomplete_work_orders:
-            work_order.pico_delete()
-            work_order.unlink()
+        incomplete_work_orders.pico_delete()
+        incomplete_work_orders.unlink()
 
     def action_cancel(self):
         res = super().action_cancel()
@@ -47,48 +168,152 @@ class MRPProduction(models.Model):
         self.bom_id.pico_workflow_id.validate_bom_setup(self.bom_id, should_raise=True)
 
     def pico_complete(self):
-        pending_work_orders = self.pico_work_order_ids.filtered(lambda wo: wo.state == 'pending')
-        while pending_work_orders:
-            work_orders = self.env['mrp.production.pico.work.order'].browse()
-            for pending in pending_work_orders:
-                if not work_orders.filtered(lambda wo: wo.process_id == pending.process_id):
-                    work_orders += pending
-            if work_orders.mapped('process_id') == self.pico_process_id.process_ids:
-                # work_orders is a 'complete set'
-                # reduce the pending work orders
-                pending_work_orders -= work_orders
-                self._pico_complete(work_orders)
-                # mark lines as complete
-                work_orders.write({'state': 'done'})
-            else:
-                # couldn't find a 'complete set'
-                pending_work_orders = None
+        # process ids needed for a complete set, by the production's process
+        set_process_ids = {}
+        for production in self:
+            process_ids = set_process_ids.get(production.pico_process_id.id)
+            if process_ids is None:
+                process_ids = set_process_ids[production.pico_process_id.id] = production.pico_process_id.process_ids.ids
+            if not process_ids or not production._pico_set_ready(process_ids):
+                continue
+            pending_work_orders = self.env['mrp.production.pico.work.order'].search([
+                ('production_id', '=', production.id),
+                ('state', '=', 'pending'),
+            ], order='id')
+            complete_sets = match_complete_sets([(wo.id, wo.process_id.id) for wo in pending_work_orders],
+                                                process_ids)
+            if complete_sets:
+                production._pico_complete_sets([pending_work_orders.browse(ids) for ids in complete_sets])
+                if production.bom_id.pico_release_window and production.state not in ('done', 'cancel'):
+                    qty = production._pico_release_qty()
+                    if qty:
+                        production._pico_create_work_orders(qty)
+
+    def _pico_set_ready(self, process_ids):
+        """
+        Whether the counters say every process of a set has a pending work order, so that the pending work
+        orders are only loaded when a set may be ready.
+        Counters out of step with the work orders (missing rows, or states changed outside the ORM) are
+        caught by counting the pending work orders by process when they say no set is ready, and recomputed.
+        """
+        self.ensure_one()
+        progress = self._pico_progress()
+        if all(process_id in progress and progress[process_id].pending_count > 0 for process_id in process_ids):
+            return True
+        pending_counts = {group['process_id'][0]: group['process_id_count'] for group in
+                          self.env['mrp.production.pico.work.order'].read_group([
+                              ('production_id', '=', self.id),
+                              ('state', '=', 'pending'),
+                              ('process_id', '!=', False),
+                          ], ['process_id'], ['process_id'])}
+        if pending_counts == {process_id: p.pending_count for process_id, p in progress.items() if p.pending_count}:
+            return False
+        _logger.warning('Pico progress of %s is out of step with its work orders, recomputing.', self.name)
+        self.env['mrp.production.pico.progress']._pico_recompute(self.ids)
+        progress = self._pico_progress()
+        return all(process_id in progress and progress[process_id].pending_count > 0 for process_id in process_ids)
+
+    def _pico_complete_sets(self, work_order_sets):
+        # work_order_sets is a list of 'complete sets' that are all ready
+        # attr values of each set, looked up for every lot and tracked move below
+        attr_indexes = {tuple(work_orders.ids): work_orders._pico_attr_index() for work_orders in work_order_sets}
+        serials = self._pico_find_or_create_serials(self._pico_sets_serial_names(work_order_sets, attr_indexes))
+        for group in self._pico_group_sets(work_order_sets, attr_indexes):
+            self._pico_complete_units(group, serials=serials, attr_indexes=attr_indexes)
+        # mark lines as complete
+        self.env['mrp.production.pico.work.order'].concat(*work_order_sets).write({'state': 'done'})
 
     def _pico_find_or_create_serial(self, product, serial_name):
-        serial = self.env['stock.production.lot'].search([
-            ('product_id', '=', product.id),
-            ('name', '=', serial_name),
-        ], limit=1)
-        if not serial:
-            serial = serial.create({
-                'product_id': product.id,
+        return self._pico_find_or_create_serials([(product, serial_name)])[(product.id, serial_name)]
+
+    def _pico_find_or_create_serials(self, product_serial_names):
+        """
+        Finds (with one search) or creates (with one create) the lots for many (product, serial_name).
+        Returns a dict of (product id, serial_name) -> stock.production.lot
+        """
+        keys = sorted({(product.id, serial_name) for product, serial_name in product_serial_names})
+        lot_model = self.env['stock.production.lot']
+        if not keys:
+            return {}
+        lots = lot_model.search([
+            ('product_id', 'in', list({product_id for product_id, _name in keys})),
+            ('name', 'in', list({serial_name for _product_id, serial_name in keys})),
+        ])
+        serials = {}
+        for lot in lots:
+            serials.setdefault((lot.product_id.id, lot.name), lot)
+        missing = [key for key in keys if key not in serials]
+        if missing:
+            created = lot_model.create([{
+                'product_id': product_id,
                 'name': serial_name,
                 'company_id': self.env.user.company_id.id,
                 # Required for creating, search may pick up any you have permissions to
-            })
-        return serial
-
-    def _pico_complete(self, work_orders):
+            } for product_id, serial_name in missing])
+            serials.update(zip(missing, created))
+        return serials
+
+    def _pico_sets_serial_names(self, work_order_sets, attr_indexes=None):
+        # (product, serial_name) of every lot that completing work_order_sets will need
+        attr_indexes = attr_indexes or {}
+        product_serial_names = []
+        tracked_moves = self.move_raw_ids.filtered(lambda m: m.has_tracking in ('lot', 'serial'))
+        for work_orders in work_order_sets:
+            attr_index = attr_indexes.get(tuple(work_orders.ids)) or work_orders._pico_attr_index()
+            if self.product_id.tracking != 'none':
+                serial_name = work_orders.find_finished_serial(attr_index)
+                if serial_name:
+                    product_serial_names.append((self.product_id, serial_name))
+            for move in tracked_moves:
+                serial_name = work_orders.find_consumed_serial(move.bom_line_id, attr_index)
+                if serial_name:
+                    product_serial_names.append((move.product_id, serial_name))
+        return product_serial_names
+
+    def _pico_group_sets(self, work_order_sets, attr_indexes=None):
+        # sets that can be produced in one wizard run, which has a single finished lot
+        # a serial is a single unit, Odoo 13 produces a serial tracked product one unit per wizard run
+        if len(work_order_sets) == 1 or self.product_id.tracking == 'serial':
+            return [[work_orders] for work_orders in work_order_sets]
+        attr_indexes = attr_indexes or {}
+        groups = {}
+        for work_orders in work_order_sets:
+            finished_serial = None
+            if self.product_id.tracking == 'lot':
+                finished_serial = work_orders.find_finished_serial(attr_indexes.get(tuple(work_orders.ids)))
+            groups.setdefault(finished_serial, []).append(work_orders)
+        return list(groups.values())
+
+    def _pico_complete(self, work_orders, serials=None):
         # work_orders should be a 'complete set' of Pico Work Orders
+        return self._pico_complete_units([work_orders], serials=serials)
+
+    def _pico_complete_units(self, work_order_sets, serials=None, attr_indexes=None):
+        # work_order_sets are 'complete sets' of Pico Work Orders, one per unit, all with the same finished lot
+        # serials are the pre-fetched lots from _pico_find_or_create_serials()
+        if serials is None:
+            serials = {}
+        attr_indexes = dict(attr_indexes or {})
+        for unit_work_orders in work_order_sets:
+            if tuple(unit_work_orders.ids) not in attr_indexes:
+                attr_indexes[tuple(unit_work_orders.ids)] = unit_work_orders._pico_attr_index()
+
+        def find_or_create_serial(product, serial_name):
+            serial = serials.get((product.id, serial_name))
+            if not serial:
+                serial = serials[(product.id, serial_name)] = self._pico_find_or_create_serial(product, serial_name)
+            return serial
+
+        work_orders = work_order_sets[0]
         produce = self.env['mrp.product.produce'].with_context(default_production_id=self.id).create({})
         work_order_consumed_in_real_time = work_orders[0]._workorder_should_consume_in_real_time()
-        produce.qty_producing = 1
-        if produce.serial:
-            # requires finished serial number
-            serial_name = work_orders.find_finished_serial()
+        produce.qty_producing = len(work_order_sets)
+        if self.product_id.tracking != 'none':
+            # requires finished serial number (or lot, produce.serial is only set for serials)
+            serial_name = work_orders.find_finished_serial(attr_indexes[tuple(work_orders.ids)])
             if not serial_name:
                 raise self.no_finished_serial_err
-            serial = self._pico_find_or_create_serial(produce.product_id, serial_name)
+            serial = find_or_create_serial(produce.product_id, serial_name)
             # Assign lot we found or created
             produce.finished_lot_id = serial
             if work_order_consumed_in_real_time:
@@ -100,13 +325,19 @@ class MRPProduction(models.Model):
                 })
         if not work_order_consumed_in_real_time:
             # if we always do this, we will over-consume
-            produce._generate_produce_lines()
-            for line in produce.raw_workorder_line_ids.filtered(lambda line: line.product_tracking in ('lot', 'serial')):
-                serial_name = work_orders.find_consumed_serial(line.move_id.bom_line_id)
-                if not serial_name:
-                    raise ValueError('Stock Move requires a consumed serial, but none provided.')
-                serial = self._pico_find_or_create_serial(line.product_id, serial_name)
-                line.lot_id = serial
+            # the consumed lot of each unit, by move
+            consumed_lots = {}
+            for move in self.move_raw_ids.filtered(lambda m: m.has_tracking in ('lot', 'serial')
+                                                   and m.state not in ('done', 'cancel')):
+                lots = []
+                for unit_work_orders in work_order_sets:
+                    serial_name = unit_work_orders.find_consumed_serial(
+                        move.bom_line_id, attr_indexes[tuple(unit_work_orders.ids)])
+                    if not serial_name:
+                        raise ValueError('Stock Move requires a consumed serial, but none provided.')
+                    lots.append(find_or_create_serial(move.product_id, serial_name))
+                consumed_lots[move.id] = lots
+            produce._generate_produce_lines(consumed_lots=consumed_lots)
         produce.do_produce()
         # If this is the last qty to produce, we can finish the MRP Production
         if self.state == 'to_close':
@@ -119,6 +350,10 @@ class MRPBoM(models.Model):
 
     pico_process_id = fields.Many2one('pico.workflow.process', string='Pico Process ID')
     pico_workflow_id = fields.Many2one(related='pico_process_id.workflow_id', string='Pico Workflow ID', store=True)
+    pico_release_window = fields.Integer(string='Pico Release Window',
+                                         help='Units of a Manufacturing Order that are open in Pico at a time, '
+                                              'more are released as they are completed. '
+                                              '0 releases every unit when the order is confirmed.')
 
     @api.onchange('pico_process_id')
     def _onchange_pico_process(self):
@@ -151,9 +386,10 @@ class MRPPicoWorkOrder(models.Model):
     _description = 'Pico Work Order'
     _rec_name = 'pico_id'
 
+    # indexed by the partial unique index in init()
     pico_id = fields.Char()
     process_id = fields.Many2one('pico.workflow.process', string='Process')
-    production_id = fields.Many2one('mrp.production', string='Manufacturing Order', required=True)
+    production_id = fields.Many2one('mrp.production', string='Manufacturing Order', required=True, index=True)
     state = fields.Selection([
         ('draft', 'Draft'),
         ('running', 'Running'),
@@ -164,35 +400,161 @@ class MRPPicoWorkOrder(models.Model):
     date_complete = fields.Datetime(string='Completed At')
     cycle_time = fields.Integer(string='Cycle Time')
     attr_value_ids = fields.One2many('mrp.pico.work.order.attr.value', 'work_order_id', string='Attr. Values')
+    # compact storage of the attr values, a JSON object of attr pico_id -> value (see _pico_compact_attrs())
+    pico_attr_values = fields.Text(string='Attr. Values (Compact)', copy=False)
     build_url = fields.Char()
     show_build_url = fields.Boolean()
     process_version = fields.Char()
     build_url_set = fields.Boolean(compute="_set_build_url_set")
 
+    def init(self):
+        if not index_exists(self.env.cr, 'mrp_production_pico_work_order_pico_id_uniq'):
+            # completions always went to the first work order with a pico_id, the others never got one
+            self.env.cr.execute("""
+                UPDATE mrp_production_pico_work_order wo
+                   SET pico_id = NULL
+                  FROM (
+                    SELECT pico_id, min(id) AS keep_id
+                    FROM mrp_production_pico_work_order
+                    WHERE pico_id IS NOT NULL
+                    GROUP BY pico_id
+                    HAVING count(*) > 1
+                  ) duplicate
+                 WHERE wo.pico_id = duplicate.pico_id AND wo.id != duplicate.keep_id
+             RETURNING wo.id, duplicate.pico_id
+            """)
+            for work_order_id, pico_id in self.env.cr.fetchall():
+                _logger.warning('Cleared duplicate pico_id %s of Pico Work Order %s', pico_id, work_order_id)
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS mrp_production_pico_work_order_pico_id_uniq
+            ON mrp_production_pico_work_order (pico_id) WHERE pico_id IS NOT NULL
+        """)
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS mrp_production_pico_work_order_attr_values_gin
+            ON mrp_production_pico_work_order USING gin ((pico_attr_values::jsonb) jsonb_path_ops)
+            WHERE pico_attr_values IS NOT NULL
+        """)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        work_orders = super().create(vals_list)
+        progress_model = self.env['mrp.production.pico.progress']
+        progress_model._pico_apply(Counter(), progress_model._pico_counts(work_orders))
+        return work_orders
+
+    def write(self, vals):
+        if not {'production_id', 'process_id', 'state'}.intersection(vals):
+            return super().write(vals)
+        progress_model = self.env['mrp.production.pico.progress']
+        before = progress_model._pico_counts(self)
+        res = super().write(vals)
+        progress_model._pico_apply(before, progress_model._pico_counts(self))
+        return res
+
+    def unlink(self):
+        progress_model = self.env['mrp.production.pico.progress']
+        progress_model._pico_apply(progress_model._pico_counts(self), Counter())
+        return super().unlink()
+
     def _set_build_url_set(self):
         for wo in self:
             wo.build_url_set = not not wo.build_url
 
     def pico_create(self):
-        self._pico_create()
-
-    def _pico_create(self):
+        outbox = self.env['pico.outbox']
+        if outbox._outbox_enabled():
+            # sent to Pico by the outbox cron once this transaction commits
+            outbox._enqueue_create(self)
+        else:
+            try:
+                errors = self._pico_create(return_exceptions=True)
+            except PicoCircuitOpen:
+                # Pico is known to be down, send them later instead of failing the confirmation
+                outbox._enqueue_create(self)
+                return
+            self._pico_defer_circuit_open(errors, outbox._enqueue_create)
+
+    def _pico_create(self, return_exceptions=False):
+        """
+        Creates these work orders in Pico and writes back their ids.
+        With `return_exceptions` the work orders whose call failed are left as they are, and a list with the
+        exception raised (or None) for each work order is returned.
+        """
+        process_results = self._pico_send_create(return_exceptions=return_exceptions)
+        created = [(wo.id, result['id']) for wo, result in zip(self, process_results)
+                   if not isinstance(result, Exception)]
+        if created:
+            self.browse([wo_id for wo_id, _pico_id in created])._pico_write_back(
+                [pico_id for _wo_id, pico_id in created])
+        return [result if isinstance(result, Exception) else None for result in process_results]
+
+    def _pico_send_create(self, return_exceptions=False):
+        # creates these work orders in Pico without writing anything back, returns Pico's result for each
+        if not self:
+            return []
         api = pico_api(self.env)
-        version = self.process_id.workflow_id.version_ids[0]
-        process_result = api.create_work_order(self.process_id.pico_id,
-                                               version.pico_id,
-                                               self.production_id.name)
-        self.write({
-            'pico_id': process_result['id'],
-            'state': 'running',
-        })
+        return api.create_work_orders([(
+            wo.process_id.pico_id,
+            wo.process_id.workflow_id.version_ids[0].pico_id,
+            wo.production_id.name,
+        ) for wo in self], return_exceptions=return_exceptions)
+
+    def _pico_write_back(self, pico_ids, state='running'):
+        # pico_ids are in the same order as self, every work order gets a different id
+        # so a single UPDATE is used instead of one write() per work order
+        self.flush(['pico_id', 'state'])
+        progress_model = self.env['mrp.production.pico.progress']
+        progress_model._pico_apply(progress_model._pico_counts(self), progress_model._pico_counts(self, state))
+        self.env.cr.execute("""
+            UPDATE mrp_production_pico_work_order AS wo
+               SET pico_id = v.pico_id,
+                   state = %s,
+                   write_uid = %s,
+                   write_date = (now() at time zone 'UTC')
+              FROM unnest(%s, %s) AS v(id, pico_id)
+             WHERE wo.id = v.id
+        """, [state, self.env.uid, list(self.ids), list(pico_ids)])
+        self.invalidate_cache(['pico_id', 'state', 'write_uid', 'write_date'], self.ids)
+        self.modified(['pico_id', 'state'])
 
     def pico_delete(self):
-        self._pico_delete()
-
-    def _pico_delete(self):
+        outbox = self.env['pico.outbox']
+        if outbox._outbox_enabled():
+            outbox._enqueue_delete(self)
+        else:
+            try:
+                errors = self._pico_delete(return_exceptions=True)
+            except PicoCircuitOpen:
+                outbox._enqueue_delete(self)
+                return
+            self._pico_defer_circuit_open(errors, outbox._enqueue_delete)
+
+    def _pico_defer_circuit_open(self, errors, enqueue):
+        """
+        errors has the exception raised (or None) for each work order of self.
+        The breaker can open while a batch is being sent, only the work orders that were not sent because of it
+        are handed to enqueue for the outbox, any other error is raised.
+        """
+        for error in errors:
+            if error and not isinstance(error, PicoCircuitOpen):
+                raise error
+        deferred = self.browse([wo.id for wo, error in zip(self, errors) if isinstance(error, PicoCircuitOpen)])
+        if deferred:
+            enqueue(deferred)
+
+    def _pico_delete(self, return_exceptions=False):
+        """
+        Deletes these work orders in Pico.
+        Returns a list with the exception raised (or None) for each work order, see _pico_create().
+        """
+        # work orders without a pico_id were never created in Pico
+        work_orders = self.filtered('pico_id')
+        if not work_orders:
+            return [None] * len(self)
         api = pico_api(self.env)
-        api.delete_work_order(self.pico_id)
+        results = api.delete_work_orders(work_orders.mapped('pico_id'), return_exceptions=return_exceptions)
+        errors = {wo.id: result for wo, result in zip(work_orders, results) if isinstance(result, Exception)}
+        return [errors.get(wo.id) for wo in self]
 
     def _workorder_should_consume_in_real_time(self):
         # 1. Must be making a single 'unit' qty
@@ -210,15 +572,110 @@ class MRPPicoWorkOrder(models.Model):
         return True
 
     def pico_complete(self, values):
-        def process_datetime(value):
-            value = value.replace('T', ' ')
-            return value.split('.')[0]
         # This is called on an empty record set from the controller
         if not self:
             pico_id = values.get('workOrderId', 'SENTINEL_THAT_DOESNT_EXIST')
             self = self.search([('pico_id', '=', pico_id)], limit=1)
             if not self:
                 return
+        if self._pico_record_completion(values):
+            self.production_id.pico_complete()
+
+    @api.model
+    def pico_complete_batch(self, values_list):
+        """
+        Complete many work orders, running the production step once per production.
+        Returns a list with the exception raised (or None) for each of values_list.
+        """
+        pico_ids = [values.get('workOrderId') for values in values_list]
+        work_orders = self.search([('pico_id', 'in', [pico_id for pico_id in pico_ids if pico_id])])
+        work_orders_by_pico_id = {wo.pico_id: wo for wo in work_orders}
+        completions_by_production = {}
+        for i, values in enumerate(values_list):
+            work_order = work_orders_by_pico_id.get(values.get('workOrderId'))
+            if work_order:
+                completions_by_production.setdefault(work_order.production_id, []).append((i, work_order, values))
+
+        errors = [None] * len(values_list)
+        for production, completions in completions_by_production.items():
+            try:
+                with self.env.cr.savepoint():
+                    needs_complete = False
+                    for _i, work_order, values in completions:
+                        needs_complete |= work_order._pico_record_completion(values)
+                    if needs_complete:
+                        production.pico_complete()
+            except Exception as e:
+                _logger.warning('Pico completion failed for %s: %s', production.name, e)
+                for i, _work_order, _values in completions:
+                    errors[i] = e
+        return errors
+
+    @api.model
+    def _cron_reconcile(self, min_age=10):
+        """
+        Asks Pico for the status of running work orders, recovering completions whose webhook was lost.
+        Work orders are paged by id, completions go through pico_complete_batch() like a webhook batch.
+        """
+        auto_commit = not getattr(threading.currentThread(), 'testing', False)
+        params = self.env['ir.config_parameter'].sudo()
+        # status requests per second, 0 for no limit
+        rate_limit = float(params.get_param('pico.reconcile.rate_limit', 10) or 0)
+        api = pico_api(self.env)
+        # recently written work orders may still have a webhook on its way
+        written_before = fields.Datetime.now() - timedelta(minutes=min_age)
+        started = monotonic()
+        request_count = 0
+        last_id = 0
+        while True:
+            work_orders = self.search([
+                ('state', '=', 'running'),
+                ('pico_id', '!=', False),
+                ('write_date', '<', written_before),
+                ('id', '>', last_id),
+            ], order='id', limit=api.batch_size)
+            if not work_orders:
+                break
+            last_id = work_orders[-1].id
+            if rate_limit:
+                wait = request_count / rate_limit - (monotonic() - started)
+                if wait > 0:
+                    sleep(wait)
+            try:
+                results = api.get_work_orders(work_orders.mapped('pico_id'))
+            except PicoCircuitOpen:
+                _logger.info('Pico reconciliation postponed, circuit breaker is open')
+                break
+            request_count += 1 if api.batch_endpoint else len(work_orders)
+
+            completions = []
+            for work_order, result in zip(work_orders, results):
+                if isinstance(result, Exception):
+                    _logger.warning('Pico reconciliation could not get work order %s: %s', work_order.pico_id, result)
+                elif result and result.get('completedAt'):
+                    completions.append(dict(result, workOrderId=work_order.pico_id))
+            if completions:
+                _logger.info('Pico reconciliation found %s lost completions', len(completions))
+                if auto_commit:
+                    # webhooks may be completing the same productions
+                    lock_productions_for_transaction(self.env.cr, self.search([
+                        ('pico_id', 'in', [values['workOrderId'] for values in completions]),
+                    ]).mapped('production_id').ids)
+                    self.invalidate_cache()
+                for values, error in zip(completions, self.pico_complete_batch(completions)):
+                    if error:
+                        _logger.warning('Pico reconciliation failed to complete %s: %s', values['workOrderId'], error)
+            if auto_commit:
+                self.env.cr.commit()
+
+    def _pico_record_completion(self, values):
+        """
+        Writes the completion values on this work order and consumes in real time when possible.
+        Returns True when the production should look for complete sets.
+        """
+        def process_datetime(value):
+            value = value.replace('T', ' ')
+            return value.split('.')[0]
 
         # if work order already completed, just update work order attributes
         # leave state as done, and don't consume or produce
@@ -244,65 +701,177 @@ class MRPPicoWorkOrder(models.Model):
                 #clear previous attributes
                 for attr_value_id in self.attr_value_ids:
                     line_commands.append((2, attr_value_id.id, 0))
+            attrs_by_pico_id = self.process_id._attrs_by_pico_id()
+            compact = self._pico_compact_attrs()
+            compact_values = {}
             for attr_vals in values.get('attributes', []):
-                attr = self.process_id.attr_ids.filtered(lambda a: a.pico_id == attr_vals['id'])
-                if attr:
+                attr = attrs_by_pico_id.get(attr_vals['id'])
+                if not attr:
+                    continue
+                if compact:
+                    compact_values.setdefault(attr.pico_id, attr_vals['value'])
+                else:
                     line_commands.append((0, 0, {
                         'value': attr_vals['value'],
                         'attr_id': attr.id,
                     }))
             if line_commands:
                 write_vals['attr_value_ids'] = line_commands
+            if compact_values or self.pico_attr_values:
+                write_vals['pico_attr_values'] = dumps(compact_values) if compact_values else False
         self.write(write_vals)
         if already_done:
             # don't consume or produce
-            return
+            return False
         if self._workorder_should_consume_in_real_time():
             # only complete moves related to the completed process
+            move_serial_names = []
+            attr_index = self._pico_attr_index()
             for move in self.production_id.move_raw_ids.filtered(lambda m: m.bom_line_id.pico_process_id == self.process_id):
-                lot_id = False
+                serial_name = None
                 if move.needs_lots:
-                    serial_name = self.find_consumed_serial(move.bom_line_id)
+                    serial_name = self.find_consumed_serial(move.bom_line_id, attr_index)
                     if not serial_name:
                         # do not want to raise error because we want the transaction to finish and queue
                         # the completion
                         break
-                    serial = self.production_id._pico_find_or_create_serial(move.product_id, serial_name)
-                    lot_id = serial.id
+                move_serial_names.append((move, serial_name))
+            serials = self.production_id._pico_find_or_create_serials(
+                [(move.product_id, serial_name) for move, serial_name in move_serial_names if serial_name])
+            # collected for one write per distinct (qty_done, lot_id) and a single create
+            move_line_model = self.env['stock.move.line']
+            move_line_updates = {}
+            move_line_creates = []
+            for move, serial_name in move_serial_names:
+                lot_id = serial_name and serials[(move.product_id.id, serial_name)].id or False
                 if move.move_line_ids:
                     # Line was 'reserved', we may have a new serial, but we will for sure increment done qty
-                    move.move_line_ids.write({
-                        'qty_done': move.product_uom_qty,
-                        'lot_id': lot_id,
-                    })
+                    key = (move.product_uom_qty, lot_id)
+                    move_line_updates[key] = move_line_updates.get(key, move_line_model) | move.move_line_ids
                 else:
                     # Was not reserved, create new line manually (will result in underflow if inventory isn't available)
-                    move.write({
-                        'move_line_ids': [(0, 0, {
-                            'product_id': move.product_id.id,
-                            'location_id': move.location_id.id,
-                            'location_dest_id': move.location_dest_id.id,
-                            'product_uom_id': move.product_uom.id,
-                            'qty_done': move.product_uom_qty,
-                            'lot_id': lot_id,
-                        })]
+                    move_line_creates.append({
+                        'move_id': move.id,
+                        'product_id': move.product_id.id,
+                        'location_id': move.location_id.id,
+                        'location_dest_id': move.location_dest_id.id,
+                        'product_uom_id': move.product_uom.id,
+                        'qty_done': move.product_uom_qty,
+                        'lot_id': lot_id,
                     })
+            for (qty_done, lot_id), move_lines in move_line_updates.items():
+                move_lines.write({
+                    'qty_done': qty_done,
+                    'lot_id': lot_id,
+                })
+            if move_line_creates:
+                move_line_model.create(move_line_creates)
+        return True
 
-        self.production_id.pico_complete()
-
-    def find_finished_serial(self):
+    @api.model
+    def _pico_compact_attrs(self):
+        return bool(self.env['ir.config_parameter'].sudo().get_param('pico.attr.compact', False))
+
+    def _pico_attr_values(self):
+        # (attr, value) recorded on these work orders, in either storage
+        attr_model = self.env['pico.workflow.process.attr']
+        compact_values = [(wo, loads(wo.pico_attr_values)) for wo in self if wo.pico_attr_values]
+        pico_ids = {pico_id for _wo, values in compact_values for pico_id in values}
+        # resolved by pico_id alone like the attr_id of a row, an attr a later sync dropped from the process
+        # still resolves, the work order's own process wins if the pico_id is on several
+        attrs = attr_model.search([('pico_id', 'in', list(pico_ids))], order='id') if pico_ids else attr_model
+        attrs_by_process = {(attr.pico_id, attr.process_id.id): attr for attr in attrs}
+        attrs_by_pico_id = {}
+        for attr in attrs:
+            attrs_by_pico_id.setdefault(attr.pico_id, attr)
+        compact_values = dict(compact_values)
+        attr_values = []
+        for wo in self:
+            attr_values += [(av.attr_id, av.value) for av in wo.attr_value_ids]
+            attr_values += [(attrs_by_process.get((pico_id, wo.process_id.id))
+                             or attrs_by_pico_id.get(pico_id, attr_model), value)
+                            for pico_id, value in compact_values.get(wo, {}).items()]
+        return attr_values
+
+    def _pico_attr_index(self):
+        """
+        Index of the attr values of these work orders (usually a 'complete set'), the first value wins.
+        Keyed by attr id, and by attr type for the first produced value ('produce').
+        """
+        index = {}
+        for attr, value in self._pico_attr_values():
+            if attr:
+                index.setdefault(attr.id, value)
+                index.setdefault(attr.type, value)
+        return index
+
+    def find_finished_serial(self, attr_index=None):
         # self will be a 'complete set' of work orders
-        attr_values = self.mapped('attr_value_ids').filtered(lambda av: av.attr_type == 'produce')
-        if not attr_values:
-            return None
-        return attr_values[0].value
+        if attr_index is None:
+            attr_index = self._pico_attr_index()
+        return attr_index.get('produce')
 
-    def find_consumed_serial(self, bom_line):
+    def find_consumed_serial(self, bom_line, attr_index=None):
         # self will be a 'complete set' of work orders
-        attr_values = self.mapped('attr_value_ids').filtered(lambda av: av.attr_id == bom_line.pico_attr_id)
-        if not attr_values:
-            return None
-        return attr_values[0].value
+        if attr_index is None:
+            attr_index = self._pico_attr_index()
+        return attr_index.get(bom_line.pico_attr_id.id)
+
+    @api.model
+    def _pico_search_attr_value(self, attr, value):
+        """ Work orders that recorded `value` for `attr` (e.g. where a serial was consumed). """
+        self.flush(['pico_attr_values'])
+        # containment is answered by the GIN index on the compact values
+        # matched by pico_id alone like _pico_attr_values(), attrs dropped from their process have none
+        self.env.cr.execute("""
+            SELECT id FROM mrp_production_pico_work_order
+            WHERE pico_attr_values IS NOT NULL AND pico_attr_values::jsonb @> %s::jsonb
+        """, [dumps({attr.pico_id: value})])
+        work_orders = self.browse([row[0] for row in self.env.cr.fetchall()])
+        attr_values = self.env['mrp.pico.work.order.attr.value'].search([
+            ('attr_id', '=', attr.id),
+            ('value', '=', value),
+        ])
+        return work_orders | attr_values.mapped('work_order_id')
+
+    @api.model
+    def _pico_migrate_attr_values(self, batch_size=1000):
+        """ Moves attr value rows into the compact column, one batch of work orders per transaction. """
+        auto_commit = not getattr(threading.currentThread(), 'testing', False)
+        self.flush()
+        while True:
+            self.env.cr.execute("""
+                SELECT DISTINCT av.work_order_id
+                FROM mrp_pico_work_order_attr_value av
+                JOIN pico_workflow_process_attr a ON a.id = av.attr_id
+                WHERE av.work_order_id IS NOT NULL AND a.pico_id IS NOT NULL
+                LIMIT %s
+            """, [batch_size])
+            work_order_ids = [row[0] for row in self.env.cr.fetchall()]
+            if not work_order_ids:
+                break
+            # the first value of an attr wins, like find_*_serial(), and compact values already written win over rows
+            self.env.cr.execute("""
+                UPDATE mrp_production_pico_work_order wo
+                SET pico_attr_values = (agg.attr_values || COALESCE(wo.pico_attr_values::jsonb, '{}'::jsonb))::text
+                FROM (
+                    SELECT av.work_order_id, jsonb_object_agg(a.pico_id, av.value ORDER BY av.id DESC) AS attr_values
+                    FROM mrp_pico_work_order_attr_value av
+                    JOIN pico_workflow_process_attr a ON a.id = av.attr_id
+                    WHERE av.work_order_id = ANY(%s) AND a.pico_id IS NOT NULL
+                    GROUP BY av.work_order_id
+                ) agg
+                WHERE wo.id = agg.work_order_id
+            """, [work_order_ids])
+            self.env.cr.execute("""
+                DELETE FROM mrp_pico_work_order_attr_value av
+                USING pico_workflow_process_attr a
+                WHERE a.id = av.attr_id AND av.work_order_id = ANY(%s) AND a.pico_id IS NOT NULL
+            """, [work_order_ids])
+            self.invalidate_cache(['pico_attr_values', 'attr_value_ids'], work_order_ids)
+            self.env['mrp.pico.work.order.attr.value'].invalidate_cache()
+            if auto_commit:
+                self.env.cr.commit()
 
     def action_build_url(self):
         self.ensure_one()
@@ -0,0 +1,113 @@
+import threading
+from datetime import timedelta
+
+from odoo import api, models, fields
+
+from logging import getLogger
+_logger = getLogger(__name__)
+
+
+class MRPPicoWorkOrderArchive(models.Model):
+    """
+    Done Pico Work Orders moved out of mrp.production.pico.work.order once they are past retention.
+    One narrow row per work order, attr values are kept as a JSON object of attr pico_id -> value
+    ('attr:<id>' for attrs without a pico_id).
+    """
+    _name = 'mrp.production.pico.work.order.archive'
+    _description = 'Archived Pico Work Order'
+    _rec_name = 'pico_id'
+    _order = 'id desc'
+    _log_access = False
+
+    production_id = fields.Many2one('mrp.production', string='Manufacturing Order', index=True, ondelete='cascade',
+                                    readonly=True)
+    process_id = fields.Many2one('pico.workflow.process', string='Process', ondelete='set null', readonly=True)
+    pico_id = fields.Char(string='Pico ID', readonly=True)
+    date_start = fields.Datetime(string='Started At', readonly=True)
+    date_complete = fields.Datetime(string='Completed At', readonly=True)
+    cycle_time = fields.Integer(string='Cycle Time', readonly=True)
+    process_version = fields.Char(readonly=True)
+    build_url = fields.Char(readonly=True)
+    attr_values = fields.Text(string='Attr. Values', readonly=True)
+
+    @api.model
+    def _cron_archive(self, batch_size=1000):
+        """
+        Moves done work orders of finished productions older than pico.work_order.retention_days into the archive.
+        Each batch is its own short transaction and rows locked by anything else are left for the next run.
+        """
+        days = int(self.env['ir.config_parameter'].sudo().get_param('pico.work_order.retention_days', 0) or 0)
+        if days <= 0:
+            return
+        auto_commit = not getattr(threading.currentThread(), 'testing', False)
+        archive_before = fields.Datetime.now() - timedelta(days=days)
+        self.flush()
+        while True:
+            self.env.cr.execute("""
+                SELECT wo.id
+                FROM mrp_production_pico_work_order wo
+                JOIN mrp_production p ON p.id = wo.production_id
+                WHERE wo.state = 'done' AND p.state IN ('done', 'cancel')
+                  AND COALESCE(wo.date_complete, wo.write_date) < %s
+                ORDER BY wo.id
+                LIMIT %s
+                FOR UPDATE OF wo SKIP LOCKED
+            """, [archive_before, batch_size])
+            work_order_ids = [row[0] for row in self.env.cr.fetchall()]
+            if not work_order_ids:
+                break
+            self._archive_work_orders(work_order_ids)
+            if auto_commit:
+                self.env.cr.commit()
+            if len(work_order_ids) < batch_size:
+                break
+
+    @api.model
+    def _archive_work_orders(self, work_order_ids):
+        _logger.info('Archiving %s Pico Work Orders', len(work_order_ids))
+        self.env.cr.execute("""
+            INSERT INTO mrp_production_pico_work_order_archive
+                (production_id, process_id, pico_id, date_start, date_complete, cycle_time,
+                 process_version, build_url, attr_values)
+            SELECT wo.production_id, wo.process_id, wo.pico_id, wo.date_start, wo.date_complete, wo.cycle_time,
+                   wo.process_version, wo.build_url,
+                   NULLIF(COALESCE(av_agg.attr_values, '{}'::jsonb)
+                          || COALESCE(wo.pico_attr_values::jsonb, '{}'::jsonb), '{}'::jsonb)::text
+            FROM mrp_production_pico_work_order wo
+            LEFT JOIN (
+                SELECT av.work_order_id,
+                       jsonb_object_agg(COALESCE(a.pico_id, 'attr:' || av.attr_id, 'attr_value:' || av.id), av.value
+                                        ORDER BY av.id DESC) AS attr_values
+                FROM mrp_pico_work_order_attr_value av
+                LEFT JOIN pico_workflow_process_attr a ON a.id = av.attr_id
+                WHERE av.work_order_id = ANY(%s)
+                GROUP BY av.work_order_id
+            ) av_agg ON av_agg.work_order_id = wo.id
+            WHERE wo.id = ANY(%s)
+            ORDER BY wo.id
+        """, [work_order_ids, work_order_ids])
+        self.env.cr.execute("""
+            UPDATE mrp_production p
+            SET pico_archived_count = COALESCE(p.pico_archived_count, 0) + s.work_order_count,
+                pico_archived_cycle_time = COALESCE(p.pico_archived_cycle_time, 0) + s.cycle_time,
+                pico_archived_date_complete = GREATEST(p.pico_archived_date_complete, s.date_complete)
+            FROM (
+                SELECT production_id, count(*) AS work_order_count, COALESCE(sum(cycle_time), 0) AS cycle_time,
+                       max(date_complete) AS date_complete
+                FROM mrp_production_pico_work_order
+                WHERE id = ANY(%s)
+                GROUP BY production_id
+            ) s
+            WHERE p.id = s.production_id
+        """, [work_order_ids])
+        self.env.cr.execute("DELETE FROM mrp_pico_work_order_attr_value WHERE work_order_id = ANY(%s)",
+                            [work_order_ids])
+        self.env.cr.execute("DELETE FROM mrp_production_pico_work_order WHERE id = ANY(%s)", [work_order_ids])
+        self.env['mrp.production.pico.work.order'].invalidate_cache()
+        self.env['mrp.pico.work.order.attr.value'].invalidate_cache()
+        self.env['mrp.production'].invalidate_cache([
+            'pico_work_order_ids',
+            'pico_archived_count',
+            'pico_archived_cycle_time',
+            'pico_archived_date_complete',
+        ])
@@ -0,0 +1,171 @@
+import threading
+
+from psycopg2 import OperationalError
+
+from odoo import api, models, fields
+from odoo.service.model import MAX_TRIES_ON_CONCURRENCY_FAILURE, PG_CONCURRENCY_ERRORS_TO_RETRY
+
+from odoo.addons.pico_mrp.models.pico_workflow import pico_api
+
+from logging import getLogger
+_logger = getLogger(__name__)
+
+
+class PicoOutbox(models.Model):
+    """
+    Outbound Pico API calls recorded in the same transaction as the change that needs them.
+    They are sent by a cron once that transaction has committed, so no locks are held while
+    waiting on Pico and a rolled back transaction leaves nothing behind in Pico.
+    """
+    _name = 'pico.outbox'
+    _description = 'Pico Outbox'
+    _order = 'id'
+
+    operation = fields.Selection([
+        ('create', 'Create Work Order'),
+        ('delete', 'Delete Work Order'),
+    ], string='Operation', required=True)
+    work_order_id = fields.Many2one('mrp.production.pico.work.order', string='Pico Work Order',
+                                    ondelete='cascade', index=True)
+    # work orders are unlinked once their delete is queued, so keep Pico's id
+    pico_id = fields.Char(string='Pico ID')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('failed', 'Failed'),
+    ], string='State', default='pending', required=True, index=True)
+    attempts = fields.Integer(string='Attempts')
+    error = fields.Text(string='Error')
+
+    max_attempts = 5
+
+    @api.model
+    def _outbox_enabled(self):
+        return bool(self.env['ir.config_parameter'].sudo().get_param('pico.outbox', False))
+
+    @api.model
+    def _enqueue_create(self, work_orders):
+        return self.sudo().create([{
+            'operation': 'create',
+            'work_order_id': wo.id,
+        } for wo in work_orders])
+
+    @api.model
+    def _enqueue_delete(self, work_orders):
+        # a create that has not been sent yet is cancelled with its work order (ondelete cascade)
+        return self._enqueue_delete_pico_ids(work_orders.filtered('pico_id').mapped('pico_id'))
+
+    @api.model
+    def _enqueue_delete_pico_ids(self, pico_ids):
+        return self.sudo().create([{
+            'operation': 'delete',
+            'pico_id': pico_id,
+        } for pico_id in pico_ids])
+
+    @api.model
+    def _cron_flush(self, limit=1000):
+        auto_commit = not getattr(threading.currentThread(), 'testing', False)
+        entries = self.search([('state', '=', 'pending')], limit=limit)
+        batch_size = int(self.env['ir.config_parameter'].sudo().get_param('pico.batch.size', 100))
+        breaker = entries and pico_api(self.env).breaker
+        for i in range(0, len(entries), batch_size):
+            if breaker.state == 'open':
+                # Pico is down, the rest waits for a later run without using up its attempts
+                _logger.info('Pico Outbox flush postponed, circuit breaker is open')
+                break
+            batch = entries[i:i + batch_size]
+            batch.filtered(lambda e: e.operation == 'create')._flush_create(auto_commit=auto_commit)
+            batch.filtered(lambda e: e.operation == 'delete')._flush_delete()
+            if auto_commit:
+                self.env.cr.commit()
+
+    def _flush_create(self, auto_commit=False):
+        if not self:
+            return
+        work_orders = self.mapped('work_order_id').filtered(lambda wo: not wo.pico_id)
+        try:
+            # creates are not idempotent, the ids of the ones that succeeded are kept whatever happens to the rest
+            results = work_orders._pico_send_create(return_exceptions=True)
+        except Exception as e:
+            # nothing was sent (e.g. the circuit breaker is open)
+            _logger.warning('Pico Outbox failed to create work orders: %s', e)
+            self._record_failure(e)
+            return
+        errors = {wo.id: result for wo, result in zip(work_orders, results) if isinstance(result, Exception)}
+        created = {wo.id: result['id'] for wo, result in zip(work_orders, results)
+                   if not isinstance(result, Exception)}
+        # the production may have been cancelled (and its work orders deleted) while waiting on Pico
+        live_ids = self._lock_live_work_orders(list(created), auto_commit)
+        cancelled = [pico_id for wo_id, pico_id in created.items() if wo_id not in live_ids]
+        if cancelled:
+            _logger.info('Pico Outbox deleting %s work orders of cancelled productions', len(cancelled))
+            self._enqueue_delete_pico_ids(cancelled)
+        live = work_orders.browse([wo_id for wo_id in created if wo_id in live_ids])
+        if live:
+            live._pico_write_back([created[wo_id] for wo_id in live.ids])
+        done = self.browse()
+        for entry in self.exists():
+            error = errors.get(entry.work_order_id.id)
+            if error:
+                _logger.warning('Pico Outbox failed to create work order %s: %s', entry.work_order_id.id, error)
+                entry._record_failure(error)
+            else:
+                done |= entry
+        done.unlink()
+
+    @api.model
+    def _lock_live_work_orders(self, work_order_ids, auto_commit=False):
+        """
+        Locks the work orders of work_order_ids and their productions, returns the ids of those still there
+        and not cancelled.
+        With auto_commit the transaction is committed first (nothing was written since the last commit) so that
+        the check sees what was committed while waiting on Pico, and restarted if a production changes meanwhile.
+        """
+        if not work_order_ids:
+            return set()
+        tries = 0
+        while True:
+            if auto_commit:
+                self.env.cr.commit()
+                self.invalidate_cache()
+            self.env['mrp.production'].flush(['state'])
+            try:
+                self.env.cr.execute("""
+                    SELECT wo.id FROM mrp_production_pico_work_order wo
+                    JOIN mrp_production p ON p.id = wo.production_id
+                    WHERE wo.id = ANY(%s) AND p.state != 'cancel'
+                    ORDER BY p.id, wo.id
+                    FOR UPDATE
+                """, [work_order_ids])
+                return {row[0] for row in self.env.cr.fetchall()}
+            except OperationalError as e:
+                tries += 1
+                if not auto_commit or e.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY \
+                        or tries >= MAX_TRIES_ON_CONCURRENCY_FAILURE:
+                    raise
+                self.env.cr.rollback()
+
+    def _flush_delete(self):
+        if not self:
+            return
+        api = pico_api(self.env)
+        results = api.delete_work_orders(self.mapped('pico_id'), return_exceptions=True)
+        done = self.browse()
+        for entry, result in zip(self, results):
+            if isinstance(result, Exception):
+                _logger.warning('Pico Outbox failed to delete work order %s: %s', entry.pico_id, result)
+                entry._record_failure(result)
+            else:
+                done |= entry
+        done.unlink()
+
+    def _record_failure(self, error):
+        for entry in self:
+            attempts = entry.attempts + 1
+            entry.write({
+                'attempts': attempts,
+                'error': str(error),
+                'state': 'failed' if attempts >= self.max_attempts else 'pending',
+            })
+
+    def action_retry(self):
+        self.write({'state': 'pending', 'attempts': 0, 'error': False})
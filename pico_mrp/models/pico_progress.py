@@ -0,0 +1,120 @@
+from collections import Counter
+
+from odoo import api, models, fields
+
+STATES = ('draft', 'running', 'pending', 'done')
+
+# counters of the work orders (archived ones are done), filtered by the %s condition
+COUNT_QUERY = """
+    INSERT INTO mrp_production_pico_progress
+        (production_id, process_id, draft_count, running_count, pending_count, done_count)
+    SELECT production_id, process_id,
+           count(*) FILTER (WHERE state = 'draft'),
+           count(*) FILTER (WHERE state = 'running'),
+           count(*) FILTER (WHERE state = 'pending'),
+           count(*) FILTER (WHERE state = 'done')
+    FROM (
+        SELECT production_id, process_id, state FROM mrp_production_pico_work_order
+        UNION ALL
+        SELECT production_id, process_id, 'done' FROM mrp_production_pico_work_order_archive
+    ) wo
+    WHERE production_id IS NOT NULL AND process_id IS NOT NULL %s
+    GROUP BY production_id, process_id
+"""
+
+
+class MRPProductionPicoProgress(models.Model):
+    """
+    Pico Work Order counts by state for each production and process.
+    Kept up to date as work orders are created, change state and are deleted (see MRPPicoWorkOrder) so that
+    progress and readiness can be read without loading the work orders. Archived work orders stay counted as done.
+    """
+    _name = 'mrp.production.pico.progress'
+    _description = 'Pico Production Progress'
+    _order = 'production_id, process_id'
+    _log_access = False
+
+    production_id = fields.Many2one('mrp.production', string='Manufacturing Order', required=True, index=True,
+                                    ondelete='cascade', readonly=True)
+    process_id = fields.Many2one('pico.workflow.process', string='Process', required=True, ondelete='cascade',
+                                 readonly=True)
+    draft_count = fields.Integer(string='Draft', readonly=True)
+    running_count = fields.Integer(string='Running', readonly=True)
+    pending_count = fields.Integer(string='Pending', readonly=True)
+    done_count = fields.Integer(string='Done', readonly=True)
+
+    _sql_constraints = [
+        ('production_process_uniq', 'unique(production_id, process_id)', 'Progress is counted once per process.'),
+    ]
+
+    def init(self):
+        # count the work orders that existed before the counters did, for any production and process without them
+        self.env.cr.execute(COUNT_QUERY % ('', ) + """
+            ON CONFLICT (production_id, process_id) DO NOTHING
+        """)
+
+    @api.model
+    def _pico_recompute(self, production_ids):
+        """
+        Recounts the work orders of production_ids, for counters found missing or out of step with them.
+        """
+        if not production_ids:
+            return
+        production_ids = sorted(production_ids)
+        self.env['mrp.production.pico.work.order'].flush(['production_id', 'process_id', 'state'])
+        self.env.cr.execute("""
+            DELETE FROM mrp_production_pico_progress WHERE production_id = ANY(%s)
+        """, [production_ids])
+        self.env.cr.execute(COUNT_QUERY % ('AND production_id = ANY(%(production_ids)s)', ),
+                            {'production_ids': production_ids})
+        self.invalidate_cache()
+        self.env['mrp.production'].invalidate_cache(['pico_progress_ids'], production_ids)
+
+    @api.model
+    def _pico_counts(self, work_orders, state=None):
+        # Counter of (production id, process id, state) for work_orders, in state when given
+        counts = Counter()
+        for wo in work_orders:
+            if wo.production_id and wo.process_id and (state or wo.state) in STATES:
+                counts[(wo.production_id.id, wo.process_id.id, state or wo.state)] += 1
+        return counts
+
+    @api.model
+    def _pico_apply(self, before, after):
+        """
+        Moves the counters from the _pico_counts() before a change to the ones after it, with a single upsert.
+        Counters never go below zero, one that would is out of step and recomputed by MRPProduction.pico_complete().
+        """
+        deltas = {}
+        for (production_id, process_id, state) in set(before) | set(after):
+            change = after[(production_id, process_id, state)] - before[(production_id, process_id, state)]
+            if change:
+                deltas.setdefault((production_id, process_id), dict.fromkeys(STATES, 0))[state] += change
+        if not deltas:
+            return
+        # sorted so that concurrent transactions update shared rows in the same order
+        keys = sorted(deltas)
+        self.env.cr.execute("""
+            INSERT INTO mrp_production_pico_progress AS p
+                (production_id, process_id, draft_count, running_count, pending_count, done_count)
+            SELECT * FROM unnest(%s::int[], %s::int[], %s::int[], %s::int[], %s::int[], %s::int[])
+            ON CONFLICT (production_id, process_id) DO UPDATE
+               SET draft_count = p.draft_count + EXCLUDED.draft_count,
+                   running_count = p.running_count + EXCLUDED.running_count,
+                   pending_count = p.pending_count + EXCLUDED.pending_count,
+                   done_count = p.done_count + EXCLUDED.done_count
+        """, [
+            [production_id for production_id, _process_id in keys],
+            [process_id for _production_id, process_id in keys],
+        ] + [[deltas[key][state] for key in keys] for state in STATES])
+        # only rows just upserted (so already locked by this transaction) can have gone below zero
+        self.env.cr.execute("""
+            UPDATE mrp_production_pico_progress
+               SET draft_count = GREATEST(draft_count, 0),
+                   running_count = GREATEST(running_count, 0),
+                   pending_count = GREATEST(pending_count, 0),
+                   done_count = GREATEST(done_count, 0)
+             WHERE production_id = ANY(%s) AND LEAST(draft_count, running_count, pending_count, done_count) < 0
+        """, [sorted({production_id for production_id, _process_id in keys})])
+        self.invalidate_cache()
+        self.env['mrp.production'].invalidate_cache(['pico_progress_ids'])
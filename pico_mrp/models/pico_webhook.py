@@ -0,0 +1,406 @@
+import threading
+from datetime import timedelta
+from hashlib import sha256
+from json import dumps, loads
+
+from psycopg2 import OperationalError
+
+from odoo import api, models, fields
+from odoo.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY
+
+from odoo.addons.pico_mrp.models.mrp import held_production_locks, lock_productions_for_transaction, \
+    try_lock_productions, unlock_productions
+
+from logging import getLogger
+_logger = getLogger(__name__)
+
+
+WEBHOOK_METHODS = ('newWorkflowVersionMethod', 'workOrderCompleteMethod')
+
+
+class PicoWebhook(models.AbstractModel):
+    _name = 'pico.webhook'
+    _description = 'Pico Webhook'
+
+    @api.model
+    def _async_enabled(self):
+        return bool(self.env['ir.config_parameter'].sudo().get_param('pico.webhook.async', False))
+
+    @api.model
+    def _dispatch(self, method, data):
+        if method == 'newWorkflowVersionMethod':
+            return self.env['pico.workflow'].sudo().process_pico_data(data)
+        elif method == 'workOrderCompleteMethod':
+            _logger.info(data)
+            return self.env['mrp.production.pico.work.order'].sudo().pico_complete(data)
+        raise Exception('Invalid method called. (01)')
+
+    @api.model
+    def _dispatch_once(self, method, data, rpc_id=None):
+        # Pico re-delivers calls, anything already processed is skipped
+        delivery = self.env['pico.webhook.delivery'].sudo()
+        payload_hash = delivery._payload_hash(data)
+        if delivery._is_processed(rpc_id, payload_hash):
+            _logger.info('Pico duplicate delivery %s skipped', rpc_id)
+            return None
+        res = self._dispatch(method, data)
+        delivery._mark_processed(rpc_id, payload_hash)
+        return res
+
+    @api.model
+    def _lock_calls(self, calls):
+        """
+        Called by the controllers before dispatching calls (a list of (method, data)), takes the locks of the
+        productions they complete so that their deliveries are checked and processed with a snapshot taken
+        after any other delivery holding them committed, see lock_productions_for_transaction().
+        """
+        if getattr(threading.currentThread(), 'testing', False):
+            return
+        pico_ids = [data.get('workOrderId') for method, data in calls
+                    if method == 'workOrderCompleteMethod' and isinstance(data, dict) and data.get('workOrderId')]
+        if pico_ids:
+            productions = self.env['mrp.production.pico.work.order'].sudo().search(
+                [('pico_id', 'in', pico_ids)]).mapped('production_id')
+            lock_productions_for_transaction(self.env.cr, productions.ids)
+            self.invalidate_cache()
+
+    @api.model
+    def _is_valid_call(self, data):
+        id = data.get('id')
+        return bool(id) and len(str(id)) >= 14
+
+    @api.model
+    def _dispatch_batch(self, calls):
+        """
+        Process a JSON-RPC batch, returning the list of responses.
+        Work order completions are grouped so that each production is completed once per batch.
+        """
+        responses = []
+        completions = []
+        queue = self._async_enabled() and self.env['pico.webhook.queue'].sudo()
+        delivery = self.env['pico.webhook.delivery'].sudo()
+        for call in calls:
+            if not isinstance(call, dict):
+                responses.append({
+                    'jsonrpc': '2.0',
+                    'id': None,
+                    'error': {'code': -32600, 'message': 'Invalid Request'},
+                })
+                continue
+            rpc_id = call.get('id')
+            response = {'jsonrpc': '2.0', 'id': rpc_id, 'result': None}
+            if rpc_id is not None:
+                # calls without an id are notifications and get no response
+                responses.append(response)
+            method = call.get('method')
+            data = call.get('params') or {}
+            if method not in WEBHOOK_METHODS:
+                response['error'] = {'code': -32601, 'message': 'Invalid method called. (01)'}
+                continue
+            if not self._is_valid_call(data):
+                continue
+            payload_hash = delivery._payload_hash(data)
+            if delivery._is_processed(rpc_id, payload_hash):
+                continue
+            if queue:
+                queue.enqueue(method, data, rpc_id=rpc_id)
+            elif method == 'workOrderCompleteMethod':
+                completions.append((response, data, rpc_id, payload_hash))
+            else:
+                try:
+                    with self.env.cr.savepoint():
+                        self._dispatch(method, data)
+                        delivery._mark_processed(rpc_id, payload_hash)
+                except Exception as e:
+                    response['error'] = {'code': -32000, 'message': str(e)}
+
+        if completions:
+            _logger.info('Pico batch of %s completions', len(completions))
+            errors = self.env['mrp.production.pico.work.order'].sudo().pico_complete_batch(
+                [completion[1] for completion in completions])
+            for (response, _data, rpc_id, payload_hash), error in zip(completions, errors):
+                if error:
+                    response['error'] = {'code': -32000, 'message': str(error)}
+                else:
+                    delivery._mark_processed(rpc_id, payload_hash)
+        for response in responses:
+            if 'error' in response:
+                del response['result']
+        return responses
+
+
+class WorkerBudget:
+    """
+    Entries the workers of a pico.webhook.queue run may still process, shared between their threads.
+    """
+    def __init__(self, limit):
+        self.remaining = limit
+        self._lock = threading.Lock()
+
+    def take(self, count):
+        # reserves up to count entries, returns how many were reserved
+        with self._lock:
+            count = max(min(count, self.remaining), 0)
+            self.remaining -= count
+            return count
+
+    def give_back(self, count):
+        with self._lock:
+            self.remaining += count
+
+
+class PicoWebhookQueue(models.Model):
+    """
+    Webhook calls received from Pico and acknowledged before being processed.
+    A cron drains them in batches, oldest first, keeping the order for each production (or workflow).
+    Entries are partitioned by ordering_key, a worker claims whole partitions with FOR UPDATE SKIP LOCKED
+    so that several workers (threads of the cron, or crons on other nodes) process different partitions.
+    """
+    _name = 'pico.webhook.queue'
+    _description = 'Pico Webhook Queue'
+    _order = 'id'
+
+    method = fields.Char(string='Method', required=True)
+    payload = fields.Text(string='Payload', required=True)
+    rpc_id = fields.Char(string='JSON-RPC ID')
+    ordering_key = fields.Char(string='Ordering Key', index=True)
+    production_id = fields.Many2one('mrp.production', string='Manufacturing Order', ondelete='set null')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('failed', 'Failed'),
+    ], string='State', default='pending', required=True, index=True)
+    attempts = fields.Integer(string='Attempts')
+    error = fields.Text(string='Error')
+
+    max_attempts = 5
+
+    @api.model
+    def enqueue(self, method, data, rpc_id=None):
+        if method not in WEBHOOK_METHODS:
+            raise Exception('Invalid method called. (01)')
+        production = self._get_production(method, data)
+        return self.sudo().create({
+            'method': method,
+            'payload': dumps(data),
+            'rpc_id': rpc_id,
+            'production_id': production.id,
+            'ordering_key': self._get_ordering_key(method, data, production),
+        })
+
+    @api.model
+    def _get_production(self, method, data):
+        if method != 'workOrderCompleteMethod' or not data.get('workOrderId'):
+            return self.env['mrp.production']
+        return self.env['mrp.production.pico.work.order'].sudo().search(
+            [('pico_id', '=', data['workOrderId'])], limit=1).production_id
+
+    @api.model
+    def _get_ordering_key(self, method, data, production=None):
+        if method == 'workOrderCompleteMethod':
+            if production:
+                return 'production:%s' % (production.id, )
+            return 'work_order:%s' % (data.get('workOrderId'), )
+        return 'workflow:%s' % ((data.get('workflow') or {}).get('id'), )
+
+    @api.model
+    def _cron_process(self, limit=1000, batch_size=None, concurrency=None):
+        """
+        Runs `concurrency` workers (pico.webhook.queue.concurrency), each with its own cursor, claiming
+        `batch_size` entries (pico.webhook.queue.batch_size) at a time until `limit` entries were processed
+        between them. Returns the number of entries processed.
+        """
+        params = self.env['ir.config_parameter'].sudo()
+        batch_size = batch_size or int(params.get_param('pico.webhook.queue.batch_size', 100) or 100)
+        concurrency = concurrency or int(params.get_param('pico.webhook.queue.concurrency', 1) or 1)
+        budget = WorkerBudget(limit)
+        if getattr(threading.currentThread(), 'testing', False):
+            return self._run_worker(budget, batch_size, auto_commit=False)
+        if concurrency <= 1:
+            return self._run_worker(budget, batch_size)
+
+        dbname, uid, context = self.env.cr.dbname, self.env.uid, self.env.context
+        processed = []
+
+        def worker():
+            with api.Environment.manage(), self.pool.cursor() as cr:
+                processed.append(api.Environment(cr, uid, context)[self._name]._run_worker(budget, batch_size))
+
+        threads = [threading.Thread(target=worker, name='pico.webhook.queue.%s.%s' % (dbname, i))
+                   for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(processed)
+
+    @api.model
+    def _run_worker(self, budget, batch_size, auto_commit=True):
+        # budget is the WorkerBudget shared by the workers of the run, returns the number of entries processed
+        processed = 0
+        # keys with an entry to retry later (or a production locked elsewhere), anything after it for the
+        # same key has to wait for the next run
+        blocked_keys = set()
+        try:
+            while True:
+                size = budget.take(batch_size)
+                if not size:
+                    break
+                batch_processed = 0
+                try:
+                    entries = self._claim(size, blocked_keys)
+                    if auto_commit and not entries._lock_productions(blocked_keys):
+                        # the locks were taken after this transaction's snapshot, claim again in a new one
+                        budget.give_back(size)
+                        self.env.cr.rollback()
+                        continue
+                except OperationalError as e:
+                    budget.give_back(size)
+                    # a partition was processed by another worker since this transaction's snapshot
+                    if not auto_commit or e.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY:
+                        raise
+                    self.env.cr.rollback()
+                    continue
+                if not entries:
+                    budget.give_back(size)
+                    break
+                for entry in entries:
+                    if entry.ordering_key in blocked_keys:
+                        continue
+                    if not entry._process():
+                        blocked_keys.add(entry.ordering_key)
+                    batch_processed += 1
+                # entries skipped (or not claimed) are left to the other workers
+                budget.give_back(size - batch_processed)
+                processed += batch_processed
+                if auto_commit:
+                    self.env.cr.commit()
+                    unlock_productions(self.env.cr, held_production_locks(self.env.cr))
+        finally:
+            if auto_commit:
+                # the cursor goes back to the pool with its connection, so are any locks left
+                self.env.cr.rollback()
+                unlock_productions(self.env.cr, held_production_locks(self.env.cr))
+        return processed
+
+    def _lock_productions(self, blocked_keys):
+        """
+        Takes the per production locks completions take (see lock_productions_for_transaction()) for these claimed
+        entries, so that they are not completed at the same time by the reconciliation or the webhook.
+        Partitions of productions locked elsewhere are added to blocked_keys.
+        Returns True when every lock was already held, else the transaction must be restarted.
+        """
+        production_ids = {}
+        for entry in self:
+            production = entry.production_id or entry._get_production(entry.method, loads(entry.payload))
+            if production:
+                production_ids[entry] = production.id
+        locked, busy = try_lock_productions(self.env.cr, production_ids.values())
+        blocked_keys.update(entry.ordering_key for entry, production_id in production_ids.items()
+                            if production_id in busy)
+        return not locked and not busy
+
+    @api.model
+    def _claim(self, batch_size, skip_keys=()):
+        """
+        Locks and returns up to batch_size pending entries, oldest first, of partitions no other worker holds.
+        A partition is held by whoever locks its oldest pending entry.
+        """
+        self.flush()
+        self.env.cr.execute("""
+            SELECT id, ordering_key FROM pico_webhook_queue
+            WHERE id IN (
+                SELECT DISTINCT ON (ordering_key) id FROM pico_webhook_queue
+                WHERE state = 'pending' AND NOT (COALESCE(ordering_key, '') = ANY(%s))
+                ORDER BY ordering_key, id
+            )
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, [list(skip_keys), batch_size])
+        heads = self.env.cr.fetchall()
+        if not heads:
+            return self.browse()
+        self.env.cr.execute("""
+            SELECT id FROM pico_webhook_queue
+            WHERE state = 'pending' AND (id = ANY(%s) OR ordering_key = ANY(%s))
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, [[head[0] for head in heads], [head[1] for head in heads if head[1]], batch_size])
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    def _process(self):
+        # returns False when the entry will be retried, holding back later entries with the same key
+        self.ensure_one()
+        try:
+            with self.env.cr.savepoint():
+                # the worker already holds the production locks, see _lock_productions()
+                self.env['pico.webhook']._dispatch_once(self.method, loads(self.payload), self.rpc_id)
+        except Exception as e:
+            _logger.warning('Pico Webhook Queue failed to process %s (%s): %s', self.method, self.ordering_key, e)
+            attempts = self.attempts + 1
+            self.write({
+                'attempts': attempts,
+                'error': str(e),
+                'state': 'failed' if attempts >= self.max_attempts else 'pending',
+            })
+            return self.state == 'failed'
+        self.unlink()
+        return True
+
+    def action_retry(self):
+        self.write({'state': 'pending', 'attempts': 0, 'error': False})
+
+
+class PicoWebhookDelivery(models.Model):
+    """
+    Log of processed webhook calls, keyed by JSON-RPC id and payload hash.
+    Checked and written with plain SQL so a re-delivery costs one index lookup.
+    """
+    _name = 'pico.webhook.delivery'
+    _description = 'Pico Webhook Delivery'
+    _log_access = False
+
+    rpc_id = fields.Char(string='JSON-RPC ID', required=True)
+    payload_hash = fields.Char(string='Payload Hash', required=True)
+    date = fields.Datetime(string='Processed At', default=fields.Datetime.now, required=True, index=True)
+
+    _sql_constraints = [
+        ('delivery_uniq', 'unique(rpc_id, payload_hash)', 'Webhook delivery already processed.'),
+    ]
+
+    @api.model
+    def _payload_hash(self, data):
+        return sha256(dumps(data, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+    @api.model
+    def _is_processed(self, rpc_id, payload_hash):
+        self.env.cr.execute("""
+            SELECT 1 FROM pico_webhook_delivery WHERE rpc_id = %s AND payload_hash = %s
+        """, [str(rpc_id or ''), payload_hash])
+        return bool(self.env.cr.fetchone())
+
+    @api.model
+    def _mark_processed(self, rpc_id, payload_hash):
+        self.env.cr.execute("""
+            INSERT INTO pico_webhook_delivery (rpc_id, payload_hash, date)
+            VALUES (%s, %s, now() at time zone 'UTC')
+            ON CONFLICT (rpc_id, payload_hash) DO NOTHING
+        """, [str(rpc_id or ''), payload_hash])
+
+    @api.model
+    def _cron_expire(self, batch_size=10000):
+        auto_commit = not getattr(threading.currentThread(), 'testing', False)
+        days = int(self.env['ir.config_parameter'].sudo().get_param('pico.webhook.delivery.retention_days', 7))
+        expire_before = fields.Datetime.now() - timedelta(days=days)
+        while True:
+            self.env.cr.execute("""
+                DELETE FROM pico_webhook_delivery WHERE id IN (
+                    SELECT id FROM pico_webhook_delivery WHERE date < %s LIMIT %s
+                )
+            """, [expire_before, batch_size])
+            deleted = self.env.cr.rowcount
+            if auto_commit:
+                self.env.cr.commit()
+            if deleted < batch_size:
+                break
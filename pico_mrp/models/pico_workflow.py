@@ -1,3 +1,6 @@
+from hashlib import sha256
+from json import dumps, loads
+
 from odoo import api, models, fields, SUPERUSER_ID
 from odoo.exceptions import UserError, ValidationError
 from odoo.http import request
@@ -5,30 +8,82 @@ from odoo.http import request
 from .api.pico_requests import PicoMESRequest, ConnectionError, HTTPError, InvalidSchema
 
 
-def pico_api(env):
+def pico_api(env, pico_url=None):
+    # pico_url overrides the saved "pico.url", e.g. while it is being edited in the settings
     params = env['ir.config_parameter'].sudo()
-    pico_url = params.get_param('pico.url')
+    pico_url = pico_url or params.get_param('pico.url')
     pico_customer_key = params.get_param('pico.customer.key', None)
     if not pico_url:
         raise ValidationError('Creating Pico API requires a config parameter "pico.url"')
-    return PicoMESRequest(pico_url, pico_customer_key)
+    return PicoMESRequest(pico_url, pico_customer_key,
+                          batch_size=int(params.get_param('pico.batch.size', 100)),
+                          batch_endpoint=bool(params.get_param('pico.batch.endpoint', False)),
+                          pool_size=int(params.get_param('pico.http.pool_size', 10) or 10),
+                          keep_alive=params.get_param('pico.http.keep_alive', 'True') != 'False',
+                          timeout=float(params.get_param('pico.http.timeout', 30.0) or 30.0),
+                          concurrency=int(params.get_param('pico.http.concurrency', 4) or 1),
+                          retries=int(params.get_param('pico.http.retries', 3) or 0),
+                          backoff=float(params.get_param('pico.http.backoff', 0.5) or 0.0),
+                          failure_threshold=int(params.get_param('pico.circuit.failure_threshold', 5) or 5),
+                          reset_timeout=float(params.get_param('pico.circuit.reset_timeout', 30.0) or 30.0))
 
 
 class PicoBoMNeedsMap(ValidationError):
     pass
 
 
+# pico_id -> record id by (database, model), kept per worker process
+# only hits are kept and each is checked against its table before it is used, so nothing has to be invalidated
+# (the registry's ormcache can only be cleared as a whole, in every worker)
+_resolved_ids = {}
+
+
+class PicoExternalIdMixin(models.AbstractModel):
+    """ Cached pico_id -> record id lookups. """
+    _name = 'pico.external.id.mixin'
+    _description = 'Pico External ID'
+
+    @api.model
+    def _pico_resolve(self, pico_id):
+        resolved_ids = _resolved_ids.setdefault((self.env.cr.dbname, self._name), {})
+        record_id = resolved_ids.get(pico_id)
+        if record_id and self._pico_resolved(record_id, pico_id):
+            return self.browse(record_id)
+        record = self.sudo().with_context(active_test=True).search([('pico_id', '=', pico_id)], limit=1)
+        if record:
+            resolved_ids[pico_id] = record.id
+        else:
+            resolved_ids.pop(pico_id, None)
+        return self.browse(record.id)
+
+    @api.model
+    def _pico_resolved(self, record_id, pico_id):
+        # the cached id may have been rolled back, archived or changed (in another worker)
+        has_active = 'active' in self._fields
+        self.flush(['pico_id', 'active'] if has_active else ['pico_id'])
+        query = 'SELECT 1 FROM "%s" WHERE id = %%s AND pico_id = %%s' % (self._table, )
+        if has_active:
+            query += ' AND active'
+        self.env.cr.execute(query, [record_id, pico_id])
+        return bool(self.env.cr.fetchone())
+
+
 class PicoMESWorkflow(models.Model):
     _name = 'pico.workflow'
+    _inherit = 'pico.external.id.mixin'
     _description = 'Workflow'
 
     name = fields.Char("Name")
     active = fields.Boolean(default=True)
-    pico_id = fields.Char("Workflow ID")
+    pico_id = fields.Char("Workflow ID", index=True)
 
     process_ids = fields.One2many('pico.workflow.process', 'workflow_id', string='Child Processes')
     version_ids = fields.One2many('pico.workflow.version', 'workflow_id', string='Child Versions')
 
+    # last synced payload, to skip or narrow down the next sync
+    pico_payload = fields.Text("Last Synced Payload", copy=False)
+    pico_payload_hash = fields.Char("Last Synced Payload Hash", copy=False)
+
     def pico_subscribe(self):
         api = pico_api(self.env)
         base_url = self._get_base_url()
@@ -130,24 +185,68 @@ class PicoMESWorkflow(models.Model):
         if not workflow_pico_id:
             raise ValidationError('Cannot create Pico Workflow without an "id" in response.')
 
+        payload = dumps({'id': version_id, 'workflow': workflow_data}, sort_keys=True, separators=(',', ':'))
+        payload_hash = sha256(payload.encode()).hexdigest()
+
         # find or create workflow
-        workflow = self.search([('pico_id', '=', workflow_pico_id)], limit=1)
+        workflow = self._pico_resolve(workflow_pico_id)
+        if workflow and workflow.pico_payload_hash == payload_hash:
+            # same as the last sync
+            return workflow
+        diff = None
+        if workflow.pico_payload:
+            diff = workflow._pico_payload_diff({'id': version_id, 'workflow': workflow_data})
         if not workflow:
             workflow = self.create(self._get_values_from_pico_data(workflow_data))
-        else:
+        elif not diff or diff['name']:
             workflow.write({'name': workflow_data.get('name', '')})
 
         # reconcile versions
-        workflow._reconcile_versions(version_id)
+        if not diff or diff['version']:
+            workflow._reconcile_versions(version_id)
 
         # reconcile processes
-        processes = workflow_data.get('processes', [])
-        workflow._reconcile_processes(processes)
-
-        # validate all BoMs
-        workflow.validate_bom_setup()
+        changed_processes = self.env['pico.workflow.process'].browse()
+        if not diff or diff['process_ids']:
+            processes = workflow_data.get('processes', [])
+            changed_processes = workflow._reconcile_processes(processes, only=diff['process_ids'] if diff else None)
+        workflow.write({'pico_payload': payload, 'pico_payload_hash': payload_hash})
+
+        # validate BoMs that could have been affected
+        boms = workflow._get_boms_for_processes(changed_processes)
+        if boms:
+            workflow.validate_bom_setup(boms)
         return workflow
 
+    def _get_boms_for_processes(self, processes):
+        # BoMs using processes, or a process they produce for, directly or on a BoM line
+        processes |= processes.mapped('producing_process_id')
+        if not processes:
+            return self.env['mrp.bom'].browse()
+        return self.env['mrp.bom'].search([
+            '|',
+            ('pico_process_id', 'in', processes.ids),
+            ('bom_line_ids.pico_process_id', 'in', processes.ids),
+        ])
+
+    def _pico_payload_diff(self, values):
+        """
+        Structural difference between the last synced payload and values.
+        'process_ids' are the pico_ids of processes that were added, removed, moved or changed.
+        """
+        self.ensure_one()
+        last_values = loads(self.pico_payload)
+        last_workflow, workflow = last_values['workflow'], values['workflow']
+        last_processes = {p['id']: (i, p) for i, p in enumerate(last_workflow.get('processes', []), 1)}
+        processes = {p['id']: (i, p) for i, p in enumerate(workflow.get('processes', []), 1)}
+        process_ids = {p_id for p_id, process in processes.items() if last_processes.get(p_id) != process}
+        process_ids.update(set(last_processes) - set(processes))
+        return {
+            'name': last_workflow.get('name', '') != workflow.get('name', ''),
+            'version': last_values['id'] != values['id'],
+            'process_ids': process_ids,
+        }
+
     def _get_values_from_pico_data(self, values):
         return {
             'name': values.get('name', ''),
@@ -171,94 +270,116 @@ class PicoMESWorkflow(models.Model):
         if line_commands:
             self.write({'version_ids': line_commands})
 
-    def _reconcile_processes(self, process_list):
-        # commands to write on process_ids
-        line_commands = []
-        # pre-process for easy reconcile
+    def _reconcile_processes(self, process_list, only=None):
+        """
+        Returns the processes with changes that can affect BoM setup
+        (e.g. not when only a label or the sequence changed).
+        `only` limits updating existing processes to these pico_ids, when known from _pico_payload_diff()
+        """
+        process_model = self.env['pico.workflow.process']
+        changed_process_ids = set()
+        # pre-process for easy reconcile, the sequence is the position in the payload
         process_dict = {p['id']: (i, p) for i, p in enumerate(process_list, 1)}
-
         original_processes = self.process_ids
-        # all of our external pico_ids
-        original_process_pico_ids = original_processes.mapped('pico_id')
-        # processes that need updated
-        existing_processes = original_processes.filtered(lambda p: p.pico_id in process_dict)
-        for p in existing_processes:
-            new_vals = {}
-            sequence, process_vals = process_dict[p.pico_id]
-            if p.name != process_vals.get('name', ''):
-                new_vals['name'] = process_vals.get('name', '')
-            if sequence != p.sequence:
-                new_vals['sequence'] = sequence
-            attr_commands = self._reconcile_process_attrs(p, process_vals)
-            if attr_commands:
-                new_vals['attr_ids'] = attr_commands
-            if new_vals:
-                line_commands.append((1, p.id, new_vals))
-        # processes to archive (missing from current state)
-        processes_to_archive = original_processes - existing_processes
-        line_commands += [(1, p.id, {'active': False}) for p in processes_to_archive]
-        # create new processes that are missing
-        for p_id, seq_vals in process_dict.items():
-            sequence, values = seq_vals
+        original_process_pico_ids = set(original_processes.mapped('pico_id'))
+
+        # create new processes that are missing, in one go so that they can be linked below
+        new_vals_list = []
+        for p_id, (sequence, values) in process_dict.items():
             if p_id not in original_process_pico_ids:
-                new_vals = {'pico_id': p_id, 'name': values.get('name', ''), 'sequence': sequence}
+                new_vals = {'workflow_id': self.id, 'pico_id': p_id, 'name': values.get('name', ''), 'sequence': sequence}
                 attr_commands = self._reconcile_process_attrs(None, values)
                 if attr_commands:
                     new_vals['attr_ids'] = attr_commands
-                line_commands.append((0, 0, new_vals))
+                new_vals_list.append(new_vals)
+        new_processes = process_model.create(new_vals_list) if new_vals_list else process_model
+        changed_process_ids.update(new_processes.ids)
+        process_ids_by_pico_id = {p.pico_id: p.id for p in original_processes | new_processes}
+
+        # producing_process_id from the payload order
+        # a process that produces is the producing process of the processes before it
+        producing_process_ids = {}
+        producing_process_id = False
+        for sequence, values in sorted(process_dict.values(), key=lambda seq_vals: -seq_vals[0]):
+            if self._process_data_produces(values):
+                producing_process_ids[values['id']] = False
+                producing_process_id = process_ids_by_pico_id[values['id']]
+            else:
+                producing_process_ids[values['id']] = producing_process_id
+
+        # commands to write on process_ids
+        line_commands = []
+        for p in original_processes:
+            if p.pico_id not in process_dict:
+                # processes to archive (missing from current state)
+                line_commands.append((1, p.id, {'active': False}))
+                changed_process_ids.update((p.id, p.producing_process_id.id))
+                continue
+            new_vals = {}
+            sequence, process_vals = process_dict[p.pico_id]
+            if only is None or p.pico_id in only:
+                if p.name != process_vals.get('name', ''):
+                    new_vals['name'] = process_vals.get('name', '')
+                if sequence != p.sequence:
+                    new_vals['sequence'] = sequence
+                attr_commands = self._reconcile_process_attrs(p, process_vals)
+                if attr_commands:
+                    new_vals['attr_ids'] = attr_commands
+                    if any(c[0] != 1 or 'type' in c[2] for c in attr_commands):
+                        changed_process_ids.add(p.id)
+            if p.producing_process_id.id != producing_process_ids[p.pico_id]:
+                new_vals['producing_process_id'] = producing_process_ids[p.pico_id]
+                changed_process_ids.update((p.id, p.producing_process_id.id))
+            if new_vals:
+                line_commands.append((1, p.id, new_vals))
+        for p in new_processes:
+            if producing_process_ids[p.pico_id]:
+                line_commands.append((1, p.id, {'producing_process_id': producing_process_ids[p.pico_id]}))
 
         if line_commands:
             self.write({'process_ids': line_commands})
-            # propagate producing_process_id
-            # we only need to do this if we were going to create or otherwise write to processes
-            line_commands = []
-            pico_producing = self.process_ids.browse()  # Empty record to use .id == False
-            for process in self.process_ids.sorted(lambda p: -p.sequence):  # Essentially reversed()
-                if process.attr_ids.filtered(lambda a: a.type == 'produce'):
-                    # this process itself produces
-                    if process.producing_process_id:
-                        line_commands.append((1, process.id, {'producing_process_id': False}))
-                    pico_producing = process
-                else:
-                    if process.producing_process_id != pico_producing:
-                        line_commands.append((1, process.id, {'producing_process_id': pico_producing.id}))
-            if line_commands:
-                self.write({'process_ids': line_commands})
+        changed_process_ids.discard(False)
+        return process_model.browse(changed_process_ids)
+
+    @api.model
+    def _process_data_produces(self, process):
+        produced_attr_id = process.get('produced_attr_id')
+        return bool(produced_attr_id) and any(a['id'] == produced_attr_id for a in process.get('attrs', []))
 
     def _reconcile_process_attrs(self, odoo_process, process):
         line_commands = []
         attrs_dict = {a['id']: a for a in process.get('attrs', [])}
+        produced_attr_id = process.get('produced_attr_id')
+        consumed_attr_ids = set(process.get('consumed_attr_ids', []))
+
+        def attr_type(a_id):
+            if a_id == produced_attr_id:
+                return 'produce'
+            if a_id in consumed_attr_ids:
+                return 'consume'
+            return 'other'
+
         original_attrs = odoo_process and odoo_process.attr_ids or self.env['pico.workflow.process.attr']
-        original_pico_ids = original_attrs.mapped('pico_id')
-        # update existing attrs
-        existing_attrs = original_attrs.filtered(lambda a: a.pico_id in attrs_dict)
-        for a in existing_attrs:
+        original_pico_ids = set()
+        for a in original_attrs:
+            original_pico_ids.add(a.pico_id)
+            values = attrs_dict.get(a.pico_id)
+            if values is None:
+                # unlink any non existing attrs
+                line_commands.append((3, a.id, 0))
+                continue
+            # update existing attrs
             new_vals = {}
-            if a.name != attrs_dict[a.pico_id].get('label', ''):
-                new_vals['name'] = attrs_dict[a.pico_id].get('label', '')
-            if process.get('produced_attr_id') == a.pico_id:
-                if a.type != 'produce':
-                    new_vals['type'] = 'produce'
-            elif a.pico_id in process.get('consumed_attr_ids', []):
-                if a.type != 'consume':
-                    new_vals['type'] = 'consume'
-            elif a.pico_id in attrs_dict:
-                if a.type != 'other':
-                    new_vals['type'] = 'other'
+            if a.name != values.get('label', ''):
+                new_vals['name'] = values.get('label', '')
+            if a.type != attr_type(a.pico_id):
+                new_vals['type'] = attr_type(a.pico_id)
             if new_vals:
                 line_commands.append((1, a.id, new_vals))
-        # unlink any non existing attrs
-        attrs_to_unlink = original_attrs - existing_attrs
-        line_commands += [(3, a.id, 0) for a in attrs_to_unlink]
         # create new attrs
         for a_id, values in attrs_dict.items():
             if a_id not in original_pico_ids:
-                vals = {'name': values.get('label', ''), 'pico_id': a_id}
-                if process.get('produced_attr_id') == a_id:
-                    vals['type'] = 'produce'
-                elif a_id in process.get('consumed_attr_ids', []):
-                    vals['type'] = 'consume'
-                line_commands.append((0, 0, vals))
+                line_commands.append((0, 0, {'name': values.get('label', ''), 'pico_id': a_id, 'type': attr_type(a_id)}))
         return line_commands
 
 
@@ -269,22 +390,32 @@ class PicoMESProcess(models.Model):
 
     active = fields.Boolean(default=True)
     name = fields.Char("Name")
-    pico_id = fields.Char("Process ID")
+    pico_id = fields.Char("Process ID", index=True)
     attr_ids = fields.One2many('pico.workflow.process.attr', 'process_id', string='Attrs')
     sequence = fields.Integer("Sequence", default=1)
-    producing_process_id = fields.Many2one('pico.workflow.process', string='Producing Process')
+    producing_process_id = fields.Many2one('pico.workflow.process', string='Producing Process', index=True)
 
     workflow_id = fields.Many2one('pico.workflow', string='Parent Workflow')
 
-    process_ids = fields.One2many('pico.workflow.process', string='Related Processes',
-                                  compute='_compute_process_ids')
+    child_process_ids = fields.One2many('pico.workflow.process', 'producing_process_id', string='Child Processes')
+
+    # the process with the processes producing into it, stored as it is read for every completion
+    process_ids = fields.Many2many('pico.workflow.process', 'pico_workflow_process_graph_rel',
+                                   'process_id', 'related_process_id', string='Related Processes',
+                                   compute='_compute_process_ids', store=True)
+
+    def _attrs_by_pico_id(self):
+        self.ensure_one()
+        return {attr.pico_id: attr for attr in self.attr_ids}
 
-    @api.depends('workflow_id.process_ids.producing_process_id')
+    @api.depends('active', 'workflow_id', 'child_process_ids', 'child_process_ids.active',
+                 'child_process_ids.workflow_id')
     def _compute_process_ids(self):
         for process in self:
-            process.process_ids = process.workflow_id.process_ids.filtered(lambda p:
-                                                                           p == process
-                                                                           or p.producing_process_id == process)
+            related = process.child_process_ids.filtered(lambda p: p.workflow_id == process.workflow_id)
+            if process.active:
+                related |= process
+            process.process_ids = related
 
 
 class PicoMESProcessAttr(models.Model):
@@ -298,7 +429,7 @@ class PicoMESProcessAttr(models.Model):
         ('other', 'Other'),
     ], string='Type', default='other')
     name = fields.Char("Name")
-    pico_id = fields.Char("Attr ID")
+    pico_id = fields.Char("Attr ID", index=True)
 
 
 class PicoMESVersion(models.Model):
@@ -307,6 +438,6 @@ class PicoMESVersion(models.Model):
     _rec_name = 'pico_id'
 
     active = fields.Boolean(default=True)
-    pico_id = fields.Char()
+    pico_id = fields.Char(index=True)
 
     workflow_id = fields.Many2one('pico.workflow', string='Parent Workflow')
@@ -1,12 +1,60 @@
-from odoo import fields, models
+from odoo import api, fields, models
 from odoo.exceptions import UserError
 
+from odoo.addons.pico_mrp.models.pico_workflow import pico_api
+
 
 class ResConfigSettings(models.TransientModel):
     _inherit = 'res.config.settings'
 
     pico_url = fields.Char(string='Pico Endpoint URL', config_parameter='pico.url')
     pico_customer_key = fields.Char(string='Pico Customer Key', config_parameter='pico.customer.key')
+    pico_http_pool_size = fields.Integer(string='Pico Connection Pool Size', config_parameter='pico.http.pool_size',
+                                         default=10)
+    pico_http_timeout = fields.Float(string='Pico Request Timeout (s)', config_parameter='pico.http.timeout',
+                                     default=30.0)
+    pico_http_concurrency = fields.Integer(string='Pico Concurrent Requests', config_parameter='pico.http.concurrency',
+                                           default=4)
+    pico_http_retries = fields.Integer(string='Pico Retries', config_parameter='pico.http.retries', default=3)
+    pico_circuit_failure_threshold = fields.Integer(string='Pico Failures Before Suspending Calls',
+                                                    config_parameter='pico.circuit.failure_threshold', default=5)
+    pico_circuit_reset_timeout = fields.Float(string='Pico Calls Suspended For (s)',
+                                              config_parameter='pico.circuit.reset_timeout', default=30.0)
+    pico_circuit_state = fields.Selection([
+        ('closed', 'Available'),
+        ('half_open', 'Recovering'),
+        ('open', 'Unavailable'),
+    ], string='Pico Status', compute='_compute_pico_circuit_state')
+    pico_reconcile_interval = fields.Integer(string='Reconcile Running Work Orders Every (minutes)',
+                                             config_parameter='pico.reconcile.interval', default=60)
+    pico_reconcile_rate_limit = fields.Float(string='Reconciliation Requests per Second',
+                                             config_parameter='pico.reconcile.rate_limit', default=10.0)
+    pico_use_outbox = fields.Boolean(string='Send Work Orders in Background', config_parameter='pico.outbox')
+    pico_webhook_async = fields.Boolean(string='Process Webhooks in Background', config_parameter='pico.webhook.async')
+    pico_work_order_retention_days = fields.Integer(string='Archive Done Work Orders After (days)',
+                                                    config_parameter='pico.work_order.retention_days')
+    pico_webhook_queue_batch_size = fields.Integer(string='Webhook Queue Batch Size',
+                                                   config_parameter='pico.webhook.queue.batch_size', default=100)
+    pico_webhook_queue_concurrency = fields.Integer(string='Webhook Queue Workers',
+                                                    config_parameter='pico.webhook.queue.concurrency', default=1)
+    pico_compact_attrs = fields.Boolean(string='Store Work Order Attributes Compactly', config_parameter='pico.attr.compact')
+
+    def set_values(self):
+        super().set_values()
+        cron = self.env.ref('pico_mrp.ir_cron_pico_work_order_reconcile', raise_if_not_found=False)
+        if cron and self.pico_reconcile_interval > 0 and (cron.interval_number, cron.interval_type) != (
+                self.pico_reconcile_interval, 'minutes'):
+            cron.sudo().write({'interval_number': self.pico_reconcile_interval, 'interval_type': 'minutes'})
+
+    @api.depends('pico_url')
+    def _compute_pico_circuit_state(self):
+        # the breaker is kept per worker process, this is the state seen by the current worker
+        for settings in self:
+            settings.pico_circuit_state = settings.pico_url and pico_api(self.env, settings.pico_url).breaker.state
+
+    def pico_circuit_reset(self):
+        if self.pico_url:
+            pico_api(self.env, self.pico_url).breaker.reset()
 
     def pico_endpoint_subscribe(self):
         if not self.pico_url:
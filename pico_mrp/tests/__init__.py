@@ -1 +1,3 @@
 from . import test_pico_workflow
+from . import test_pico_requests
+from . import test_pico_benchmark
@@ -0,0 +1,48 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import dumps, loads
+from socketserver import ThreadingMixIn
+from threading import Thread
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PicoStandIn:
+    """
+    Local stand-in for the Pico API, answering every call with the next status in `statuses` (then 200).
+    Calls are recorded as (method, path, body) in `calls`.
+    """
+    def __init__(self, statuses=None):
+        self.statuses = list(statuses or [])
+        self.calls = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                stand_in.calls.append((self.command, self.path, body and loads(body)))
+                status = stand_in.statuses.pop(0) if stand_in.statuses else 200
+                payload = dumps(stand_in.respond(self.command, self.path, body and loads(body))).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_DELETE = _respond
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s' % (self.server.server_address[1], )
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def respond(self, method, path, body):
+        return {'id': 'wo%s' % (len(self.calls), )}
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
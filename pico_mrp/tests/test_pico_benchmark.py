@@ -0,0 +1,99 @@
+import os
+from json import dumps
+from time import sleep, time
+from unittest import skipUnless
+
+from odoo.tests.common import TransactionCase
+from odoo.addons.pico_mrp.models.api import pico_requests
+from odoo.addons.pico_mrp.models.mrp import match_complete_sets
+
+from logging import getLogger
+_logger = getLogger(__name__)
+
+
+@skipUnless(os.environ.get('PICO_BENCHMARK'), 'set PICO_BENCHMARK to run the Pico benchmarks')
+class TestBenchmark(TransactionCase):
+    """
+    Wall-clock checks, opt-in as they depend on the machine running them.
+    """
+
+    def test_match_complete_sets(self):
+        # qty 5,000 x 8 processes
+        processes = list(range(8))
+        work_orders = [(unit * 8 + process, process) for process in processes for unit in range(5000)]
+        start = time()
+        complete_sets = match_complete_sets(work_orders, processes)
+        elapsed = time() - start
+        _logger.info('match_complete_sets 5,000 x 8 took %.3fs', elapsed)
+        self.assertEqual(len(complete_sets), 5000)
+        self.assertLess(elapsed, 1.0)
+
+    def test_sync_data_large_workflow(self):
+        def process_data(i):
+            attrs = [{'id': 'p%d-a%d' % (i, j), 'label': 'A %d' % (j, )} for j in range(10)]
+            process = {'id': 'p%d' % (i, ), 'name': 'P %d' % (i, ), 'attrs': attrs, 'consumed_attr_ids': [attrs[1]['id']]}
+            if i % 10 == 9:
+                process['produced_attr_id'] = attrs[0]['id']
+            return process
+
+        response_data = {
+            "id": "v12",
+            "workflow": {
+                "id": "w156",
+                "name": "Test Flow",
+                "processes": [process_data(i) for i in range(200)],
+            }
+        }
+        workflow = self.env['pico.workflow'].process_pico_data(response_data)
+        response_data['workflow']['processes'].insert(0, process_data(200))
+        response_data['workflow']['processes'][-1].pop('produced_attr_id')
+        start = time()
+        self.env['pico.workflow'].process_pico_data(response_data)
+        workflow.flush()
+        elapsed = time() - start
+        _logger.info('sync of 201 processes with 2,010 attrs took %.3fs', elapsed)
+        self.assertEqual(len(workflow.process_ids), 201)
+        self.assertLess(elapsed, 5.0)
+
+    def test_dispatcher(self):
+        def call(i):
+            sleep(0.05)
+            return i * 2
+
+        dispatcher = pico_requests.PicoMESDispatcher(concurrency=10)
+        start = time()
+        results = dispatcher.map(call, [(i, ) for i in range(20)])
+        elapsed = time() - start
+        _logger.info('20 dispatched calls of 50ms took %.3fs', elapsed)
+        self.assertEqual(results, [i * 2 for i in range(20)])
+        # 20 calls of 50ms, 10 at a time
+        self.assertLess(elapsed, 0.5)
+
+    def test_webhook_queue_throughput(self):
+        queue = self.env['pico.webhook.queue']
+        queue.search([]).unlink()
+        partitions, per_partition = 100, 20
+        queue.create([{
+            'method': 'workOrderCompleteMethod',
+            'payload': dumps({'partition': p, 'seq': i}),
+            'ordering_key': 'production:%s' % (p, ),
+        } for i in range(per_partition) for p in range(partitions)])
+
+        processed = []
+        webhook_class = type(self.env['pico.webhook'])
+        original_dispatch_once = webhook_class._dispatch_once
+
+        def dispatch_once(webhook, method, data, rpc_id=None):
+            processed.append((data['partition'], data['seq']))
+
+        webhook_class._dispatch_once = dispatch_once
+        try:
+            start = time()
+            queue._cron_process(limit=10000, batch_size=200)
+            elapsed = time() - start
+        finally:
+            webhook_class._dispatch_once = original_dispatch_once
+        _logger.info('Pico webhook queue processed %s entries in %.2fs (%.0f/s)',
+                     len(processed), elapsed, len(processed) / elapsed)
+        self.assertEqual(len(processed), partitions * per_partition)
+        self.assertLess(elapsed, 20)
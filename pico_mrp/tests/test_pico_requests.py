@@ -0,0 +1,97 @@
+from time import sleep
+
+from odoo.tests.common import TransactionCase
+from odoo.addons.pico_mrp.models.api import pico_requests
+from odoo.addons.pico_mrp.models.pico_workflow import pico_api
+from odoo.addons.pico_mrp.tests.common import PicoStandIn
+
+
+class TestPicoRequests(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stand_in = PicoStandIn()
+        self.addCleanup(self.stand_in.stop)
+        parameters = self.env['ir.config_parameter'].sudo()
+        parameters.set_param('pico.url', self.stand_in.url)
+        parameters.set_param('pico.http.retries', 3)
+        parameters.set_param('pico.http.backoff', 0.01)
+        parameters.set_param('pico.circuit.failure_threshold', 5)
+        parameters.set_param('pico.circuit.reset_timeout', 0.2)
+        self.addCleanup(lambda: pico_requests._breakers.pop(self.stand_in.url, None))
+
+    def test_retry_idempotent(self):
+        api = pico_api(self.env)
+        self.stand_in.statuses = [503, 502]
+        api.delete_request('/work_orders/1')
+        self.assertEqual([call[0] for call in self.stand_in.calls], ['DELETE'] * 3)
+        self.assertEqual(api.breaker.state, 'closed')
+        self.assertEqual(api.breaker.failures, 0)
+
+        # a POST could create the work order twice, so it is never retried
+        self.stand_in.calls.clear()
+        self.stand_in.statuses = [503]
+        with self.assertRaises(pico_requests.HTTPError):
+            api.post_request('/work_orders', {'processId': 'p1'})
+        self.assertEqual(len(self.stand_in.calls), 1)
+
+        # a 4xx is an error in the call, it is not retried and Pico is still healthy
+        self.stand_in.calls.clear()
+        self.stand_in.statuses = [404]
+        with self.assertRaises(pico_requests.HTTPError):
+            api.delete_request('/work_orders/1')
+        self.assertEqual(len(self.stand_in.calls), 1)
+        self.assertEqual(api.breaker.failures, 0)
+
+    def test_circuit_breaker(self):
+        self.env['ir.config_parameter'].sudo().set_param('pico.circuit.failure_threshold', 2)
+        api = pico_api(self.env)
+        self.stand_in.statuses = [503] * 10
+        with self.assertRaises(pico_requests.HTTPError):
+            api.delete_request('/work_orders/1')
+        # retries stop as soon as the breaker opens
+        self.assertEqual(len(self.stand_in.calls), 2)
+        self.assertEqual(api.breaker.state, 'open')
+        # shared by every request to the same endpoint
+        self.assertEqual(pico_api(self.env).breaker.state, 'open')
+
+        # fails fast without calling Pico
+        with self.assertRaises(pico_requests.PicoCircuitOpen):
+            api.post_request('/work_orders', {'processId': 'p1'})
+        with self.assertRaises(pico_requests.ConnectionError):
+            api.delete_work_orders(['1'])
+        self.assertEqual(len(self.stand_in.calls), 2)
+
+        sleep(0.25)
+        self.assertEqual(api.breaker.state, 'half_open')
+        self.stand_in.statuses = []
+        api.post_request('/work_orders', {'processId': 'p1'})
+        self.assertEqual(api.breaker.state, 'closed')
+
+    def test_connection_error(self):
+        self.stand_in.stop()
+        api = pico_api(self.env)
+        with self.assertRaises(pico_requests.ConnectionError):
+            api.delete_request('/work_orders/1')
+        self.assertEqual(api.breaker.failures, 4)
+        self.assertEqual(api.breaker.state, 'closed')
+        with self.assertRaises(pico_requests.ConnectionError):
+            api.delete_request('/work_orders/1')
+        self.assertEqual(api.breaker.failures, 5)
+        self.assertEqual(api.breaker.state, 'open')
+        api.breaker.reset()
+        self.assertEqual(api.breaker.state, 'closed')
+
+    def test_get_work_orders_batch_error(self):
+        parameters = self.env['ir.config_parameter'].sudo()
+        parameters.set_param('pico.batch.endpoint', True)
+        parameters.set_param('pico.batch.size', 2)
+        parameters.set_param('pico.http.concurrency', 1)
+        api = pico_api(self.env)
+        # a failed batch is the result of each of its work orders, the other batches are still returned
+        self.stand_in.statuses = [404]
+        results = api.get_work_orders(['1', '2', '3'])
+        self.assertEqual(len(self.stand_in.calls), 2)
+        self.assertIsInstance(results[0], pico_requests.HTTPError)
+        self.assertIs(results[1], results[0])
+        self.assertIsNone(results[2])
@@ -1,10 +1,24 @@
 from datetime import datetime
-from collections import defaultdict
+from json import dumps, loads
+from collections import Counter, defaultdict
+import threading
+from time import sleep
+from unittest.mock import patch
+from urllib.parse import parse_qs
 
+from psycopg2 import IntegrityError
+
+from odoo import api, SUPERUSER_ID
 from odoo.tests.common import TransactionCase
+from odoo.tools import mute_logger
 from odoo.exceptions import ValidationError, UserError
 from odoo.addons.pico_mrp.models.api import pico_requests
+from odoo.addons.pico_mrp.models.api.pico_requests import PicoCircuitOpen
 from odoo.addons.pico_mrp.models.pico_workflow import pico_api
+from odoo.addons.pico_mrp.models.pico_webhook import WorkerBudget
+from odoo.addons.pico_mrp.models.mrp import match_complete_sets, held_production_locks, lock_productions, \
+    lock_productions_for_transaction, try_lock_productions, unlock_productions, PICO_PRODUCTION_LOCK
+from odoo.addons.pico_mrp.tests.common import PicoStandIn
 
 from logging import getLogger
 _logger = getLogger(__name__)
@@ -193,6 +207,10 @@ class TestWorkflow(TransactionCase):
         api = pico_api(self.env)
         res = api.create_work_order('test', 'test')
         self.assertTrue(isinstance(res, dict))
+        # connections are pooled per url and key
+        self.assertIs(pico_api(self.env).session, api.session)
+        parameters.set_param('pico.customer.key', 'other key')
+        self.assertIsNot(pico_api(self.env).session, api.session)
 
     def mrp_setup(self):
         self.assertFalse(self.product.bom_ids.pico_workflow_id.pico_id, "Expect no Pico Workflow set")
@@ -504,3 +522,1121 @@ class TestWorkflow(TransactionCase):
         self.assertTrue(work_order2)
         mo.action_cancel()
         self.assertEqual(len(mo.pico_work_order_ids), 0)
+
+    def _multi_process_setup(self, product_qty=1.0):
+        workflow = self.env['pico.workflow'].with_user(self.admin_user).create({
+            'name': 'Test Flow',
+            'pico_id': 'w156'
+        })
+        workflow.write({
+            'process_ids': [(0, 0, {
+                'name': 'Test Process',
+                'pico_id': '370',
+                'attr_ids': [
+                    (0, 0, {'pico_id': 'a1', 'name': 'A1', 'type': 'produce'}),
+                ],
+                'sequence': 2,
+            })],
+            'version_ids': [(0, 0, {
+                'pico_id': 'v12',
+            })],
+        })
+        process2 = workflow.process_ids
+        process1 = process2.create({
+            'name': 'Test Pre-Process',
+            'pico_id': '369',
+            'attr_ids': [
+                (0, 0, {'pico_id': 'a2', 'name': 'A2', 'type': 'consume'}),
+            ],
+            'sequence': 1,
+            'producing_process_id': process2.id,
+            'workflow_id': workflow.id,
+        })
+        self._product_add_workflow(workflow)
+
+        mo = self.env['mrp.production'].create({
+            'product_id': self.product.id,
+            'bom_id': self.product.bom_ids.id,
+            'product_uom_id': self.product.uom_id.id,
+            'product_qty': product_qty,
+        })
+        mo._onchange_move_raw()
+        return mo, process1, process2
+
+    def _patch_unique_work_order_ids(self):
+        # the work order id pattern patched in setUp() repeats for every unit of a production
+        counter = iter(range(1000000))
+        original_create_work_orders = pico_requests.PicoMESRequest.create_work_orders
+
+        def create_work_orders(api, work_orders, return_exceptions=False):
+            return [{'id': 'wo%d' % next(counter)} for _work_order in work_orders]
+
+        pico_requests.PicoMESRequest.create_work_orders = create_work_orders
+
+        def restore():
+            pico_requests.PicoMESRequest.create_work_orders = original_create_work_orders
+        self.addCleanup(restore)
+
+    def test_mrp_multi_qty_create(self):
+        mo, process1, process2 = self._multi_process_setup(product_qty=3.0)
+
+        calls = []
+        original_create_work_orders = pico_requests.PicoMESRequest.create_work_orders
+
+        def create_work_orders(api, work_orders, return_exceptions=False):
+            calls.append(len(work_orders))
+            return [{'id': 'wo%d' % i} for i, _ in enumerate(work_orders)]
+
+        pico_requests.PicoMESRequest.create_work_orders = create_work_orders
+        try:
+            mo.action_confirm()
+        finally:
+            pico_requests.PicoMESRequest.create_work_orders = original_create_work_orders
+
+        # every work order is sent to pico in a single call
+        self.assertEqual(calls, [6])
+        self.assertEqual(len(mo.pico_work_order_ids), 6)
+        self.assertEqual(len(mo.pico_work_order_ids.filtered(lambda w: w.process_id == process1)), 3)
+        self.assertEqual(len(mo.pico_work_order_ids.filtered(lambda w: w.process_id == process2)), 3)
+        self.assertEqual(set(mo.pico_work_order_ids.mapped('state')), {'running'})
+        self.assertEqual(sorted(mo.pico_work_order_ids.mapped('pico_id')), ['wo%d' % i for i in range(6)])
+
+    def test_mrp_outbox(self):
+        self.env['ir.config_parameter'].sudo().set_param('pico.outbox', True)
+        workflow = self.env['pico.workflow'].with_user(self.admin_user).create({
+            'name': 'Test Flow',
+            'pico_id': 'w156'
+        })
+        workflow.write({
+            'process_ids': [(0, 0, {
+                'name': 'Test Process',
+                'pico_id': '370',
+                'attr_ids': [
+                    (0, 0, {'pico_id': 'a1', 'name': 'A1', 'type': 'produce'}),
+                    (0, 0, {'pico_id': 'a2', 'name': 'A2', 'type': 'consume'}),
+                ],
+            })],
+            'version_ids': [(0, 0, {
+                'pico_id': 'v12',
+            })],
+        })
+        self._product_add_workflow(workflow)
+        mo = self.env['mrp.production'].create({
+            'product_id': self.product.id,
+            'bom_id': self.product.bom_ids.id,
+            'product_uom_id': self.product.uom_id.id,
+        })
+        mo._onchange_move_raw()
+        mo.action_confirm()
+
+        # nothing is sent to Pico until the outbox is flushed
+        outbox = self.env['pico.outbox'].search([('work_order_id', '=', mo.pico_work_order_ids.id)])
+        self.assertEqual(outbox.operation, 'create')
+        self.assertEqual(mo.pico_work_order_ids.state, 'draft')
+        self.assertFalse(mo.pico_work_order_ids.pico_id)
+
+        self.env['pico.outbox']._cron_flush()
+        self.assertFalse(outbox.exists())
+        self.assertEqual(mo.pico_work_order_ids.state, 'running')
+        self.assertEqual(mo.pico_work_order_ids.pico_id, '370v12' + mo.name)
+
+        mo.action_cancel()
+        self.assertFalse(mo.pico_work_order_ids)
+        outbox = self.env['pico.outbox'].search([('pico_id', '=', '370v12' + mo.name)])
+        self.assertEqual(outbox.operation, 'delete')
+        self.env['pico.outbox']._cron_flush()
+        self.assertFalse(outbox.exists())
+
+    def test_mrp_outbox_partial_failure(self):
+        self.env['ir.config_parameter'].sudo().set_param('pico.outbox', True)
+        mo, process1, process2 = self._multi_process_setup()
+        mo.action_confirm()
+        work_order1 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process1)
+        work_order2 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process2)
+
+        created = []
+        original_create_work_order = pico_requests.PicoMESRequest.create_work_order
+
+        def create_work_order(api, process_id, workflow_version_id, annotation=''):
+            if process_id == process2.pico_id:
+                raise ConnectionError('connection refused')
+            created.append(process_id)
+            return {'id': 'wo-' + process_id}
+
+        pico_requests.PicoMESRequest.create_work_order = create_work_order
+        try:
+            self.env['pico.outbox']._cron_flush()
+        finally:
+            pico_requests.PicoMESRequest.create_work_order = original_create_work_order
+
+        # the created work order keeps its id, only the failed one is retried
+        self.assertEqual(created, [process1.pico_id])
+        self.assertEqual(work_order1.pico_id, 'wo-' + process1.pico_id)
+        self.assertFalse(self.env['pico.outbox'].search([('work_order_id', '=', work_order1.id)]))
+        outbox = self.env['pico.outbox'].search([('work_order_id', '=', work_order2.id)])
+        self.assertEqual(outbox.attempts, 1)
+        self.assertFalse(work_order2.pico_id)
+
+        self.env['pico.outbox']._cron_flush()
+        self.assertFalse(outbox.exists())
+        self.assertEqual(work_order1.pico_id, 'wo-' + process1.pico_id)
+        self.assertTrue(work_order2.pico_id)
+
+    def test_mrp_outbox_cancelled_while_creating(self):
+        self.env['ir.config_parameter'].sudo().set_param('pico.outbox', True)
+        mo, process1, process2 = self._multi_process_setup()
+        mo.action_confirm()
+        work_orders = mo.pico_work_order_ids
+        work_order_class = type(work_orders)
+        original_send_create = work_order_class._pico_send_create
+
+        def send_create(work_orders, return_exceptions=False):
+            results = original_send_create(work_orders, return_exceptions=return_exceptions)
+            # cancelled by someone else while waiting on Pico
+            self.env.cr.execute("UPDATE mrp_production SET state = 'cancel' WHERE id = %s", [mo.id])
+            return results
+
+        with patch.object(work_order_class, '_pico_send_create', send_create):
+            self.env['pico.outbox']._cron_flush()
+
+        # the work orders just created in Pico are deleted instead of written back
+        work_orders.invalidate_cache()
+        self.assertEqual(work_orders.mapped('pico_id'), [False, False])
+        self.assertFalse(self.env['pico.outbox'].search([('operation', '=', 'create')]))
+        outbox = self.env['pico.outbox'].search([('operation', '=', 'delete')])
+        self.assertEqual(sorted(outbox.mapped('pico_id')),
+                         sorted([process1.pico_id + 'v12' + mo.name, process2.pico_id + 'v12' + mo.name]))
+
+    def test_webhook_queue(self):
+        mo, _ = self.mrp_setup()
+        work_order = mo.pico_work_order_ids
+        queue = self.env['pico.webhook.queue']
+        values = {
+            "id": "string",
+            "attributes": [
+                # Consumed Serial
+                {
+                    "id": "a2",
+                    "label": "A2",
+                    "value": "C101",
+                },
+            ],
+            "startedAt": "2020-10-01T10:40:50.043Z",
+            "completedAt": "2020-10-02T10:40:50.043Z",
+            "cycleTime": 123456,
+            "workflowId": "string",
+            "processId": "string",
+            "workOrderId": work_order.pico_id,
+        }
+        # missing the finished serial
+        entry = queue.enqueue('workOrderCompleteMethod', values)
+        self.assertEqual(entry.ordering_key, 'production:%s' % (mo.id, ))
+        self.assertEqual(entry.production_id, mo)
+        self.assertEqual(work_order.state, 'running')
+
+        queue._cron_process()
+        self.assertEqual(entry.state, 'pending')
+        self.assertEqual(entry.attempts, 1)
+        self.assertTrue(entry.error)
+        self.assertEqual(work_order.state, 'running')
+
+        # a later delivery for the same work order waits for the first
+        values['attributes'].append({"id": "a1", "label": "A1", "value": "F101"})
+        entry2 = queue.enqueue('workOrderCompleteMethod', values)
+        # the waiting delivery is not counted as processed
+        self.assertEqual(queue._cron_process(), 1)
+        self.assertEqual(entry.attempts, 2)
+        self.assertEqual(entry2.attempts, 0)
+        self.assertEqual(work_order.state, 'running')
+
+        entry.unlink()
+        queue._cron_process()
+        self.assertFalse(entry2.exists())
+        self.assertEqual(work_order.state, 'done')
+        self.assertEqual(mo.state, 'done')
+        self.assertEqual(mo.finished_move_line_ids.lot_id.name, 'F101')
+
+        with self.assertRaises(Exception):
+            queue.enqueue('unknownMethod', values)
+
+    def test_webhook_batch(self):
+        mo, process1, process2 = self._multi_process_setup()
+        mo.action_confirm()
+        work_order1 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process1)
+        work_order2 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process2)
+
+        def call(i, work_order, attr_id, value):
+            return {
+                'jsonrpc': '2.0',
+                'id': i,
+                'method': 'workOrderCompleteMethod',
+                'params': {
+                    'id': 'completion-%08d' % (i, ),
+                    'attributes': [{'id': attr_id, 'label': attr_id.upper(), 'value': value}],
+                    'startedAt': '2020-10-01T10:40:50.043Z',
+                    'completedAt': '2020-10-02T10:40:50.043Z',
+                    'cycleTime': 123,
+                    'workOrderId': work_order.pico_id,
+                },
+            }
+
+        responses = self.env['pico.webhook']._dispatch_batch([
+            call(1, work_order1, 'a2', 'C101'),
+            call(2, work_order2, 'a1', 'F101'),
+            {'jsonrpc': '2.0', 'id': 3, 'method': 'unknownMethod', 'params': {}},
+            1,
+        ])
+        self.assertEqual([r['id'] for r in responses], [1, 2, 3, None])
+        self.assertFalse(responses[0].get('error'))
+        self.assertFalse(responses[1].get('error'))
+        self.assertEqual(responses[2]['error']['code'], -32601)
+        self.assertEqual(responses[3]['error']['code'], -32600)
+
+        self.assertEqual(work_order1.state, 'done')
+        self.assertEqual(work_order2.state, 'done')
+        self.assertEqual(mo.state, 'done')
+        self.assertEqual(mo.mapped('move_raw_ids.move_line_ids.lot_id.name'), ['C101'])
+        self.assertEqual(mo.finished_move_line_ids.lot_id.name, 'F101')
+
+    def test_webhook_duplicate_delivery(self):
+        mo, _ = self.mrp_setup()
+        work_order = mo.pico_work_order_ids
+        values = {
+            "id": "completion-00000001",
+            "attributes": [
+                {"id": "a1", "label": "A1", "value": "F101"},
+                {"id": "a2", "label": "A2", "value": "C101"},
+            ],
+            "completedAt": "2020-10-02T10:40:50.043Z",
+            "workOrderId": work_order.pico_id,
+        }
+        webhook = self.env['pico.webhook']
+        webhook._dispatch_once('workOrderCompleteMethod', values, rpc_id=1)
+        self.assertEqual(work_order.state, 'done')
+        attr_values = work_order.attr_value_ids
+        self.assertEqual(len(attr_values), 2)
+
+        # the re-delivery is skipped, a done work order would otherwise recreate its attr values
+        webhook._dispatch_once('workOrderCompleteMethod', dict(values), rpc_id=1)
+        self.assertEqual(work_order.attr_value_ids, attr_values)
+
+        # same id with a different payload is processed
+        values['attributes'][0]['value'] = 'F102'
+        webhook._dispatch_once('workOrderCompleteMethod', values, rpc_id=1)
+        self.assertNotEqual(work_order.attr_value_ids, attr_values)
+
+        delivery = self.env['pico.webhook.delivery']
+        self.assertEqual(delivery.search_count([('rpc_id', '=', '1')]), 2)
+        self.env.cr.execute("UPDATE pico_webhook_delivery SET date = date - interval '30 days' WHERE rpc_id = '1'")
+        delivery._cron_expire()
+        self.assertEqual(delivery.search_count([('rpc_id', '=', '1')]), 0)
+
+    def test_pico_id_resolve(self):
+        response_data = {
+            "id": "v12",
+            "workflow": {
+                "id": "w156",
+                "name": "Test Flow",
+                "processes": [{
+                    "id": "p18",
+                    "name": "test process",
+                    'attrs': [
+                        {'id': 'a101', 'label': 'A 101'},
+                    ],
+                    'produced_attr_id': 'a101',
+                }]
+            }
+        }
+        workflow_model = self.env['pico.workflow']
+        self.assertFalse(workflow_model._pico_resolve('w156'))
+
+        workflow = workflow_model.process_pico_data(response_data)
+        self.assertEqual(workflow_model._pico_resolve('w156'), workflow)
+
+        # writing workflows leaves the registry's caches alone
+        self.registry.cache_invalidated = False
+        workflow.name = 'Renamed Flow'
+        self.assertFalse(self.registry.cache_invalidated)
+
+        # changed records are not returned from the cache
+        workflow.active = False
+        self.assertFalse(workflow_model._pico_resolve('w156'))
+        workflow.active = True
+        self.assertEqual(workflow_model._pico_resolve('w156'), workflow)
+
+        # a record cached by a rolled back transaction is not returned
+        try:
+            with self.cr.savepoint():
+                rolled_back = workflow_model.create({'name': 'Rolled Back', 'pico_id': 'w157'})
+                self.assertEqual(workflow_model._pico_resolve('w157'), rolled_back)
+                raise ValueError('rollback')
+        except ValueError:
+            pass
+        self.assertFalse(workflow_model._pico_resolve('w157'))
+
+        # the same pico_id on another work order is not allowed
+        mo, _ = self.mrp_setup()
+        with mute_logger('odoo.sql_db'), self.assertRaises(IntegrityError), self.cr.savepoint():
+            mo.pico_work_order_ids.copy({'pico_id': mo.pico_work_order_ids.pico_id})
+            mo.pico_work_order_ids.flush()
+
+    def test_match_complete_sets(self):
+        self.assertEqual(match_complete_sets([(1, 'a'), (2, 'b'), (3, 'a'), (4, 'c')], ['a', 'b']), [[1, 2]])
+        self.assertEqual(match_complete_sets([(1, 'a'), (2, 'a')], ['a', 'b']), [])
+        self.assertEqual(match_complete_sets([(1, 'a')], []), [])
+
+        # qty 5,000 x 8 processes, timed in test_pico_benchmark
+        processes = list(range(8))
+        work_orders = [(unit * 8 + process, process) for process in processes for unit in range(5000)]
+        complete_sets = match_complete_sets(work_orders, processes)
+        self.assertEqual(len(complete_sets), 5000)
+        self.assertEqual(complete_sets[0], [0, 1, 2, 3, 4, 5, 6, 7])
+
+    def test_mrp_multi_qty_complete(self):
+        mo, process1, process2 = self._multi_process_setup(product_qty=2.0)
+        self._patch_unique_work_order_ids()
+        mo.action_confirm()
+        work_orders1 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process1)
+        work_orders2 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process2)
+        self.assertEqual(len(work_orders1), 2)
+        self.assertEqual(len(work_orders2), 2)
+
+        def values(work_order, attr_id, value):
+            return {
+                'id': 'completion-' + value,
+                'attributes': [{'id': attr_id, 'label': attr_id.upper(), 'value': value}],
+                'workOrderId': work_order.pico_id,
+            }
+
+        # one set ready
+        errors = self.env['mrp.production.pico.work.order'].pico_complete_batch([
+            values(work_orders1[0], 'a2', 'C101'),
+            values(work_orders1[1], 'a2', 'C102'),
+            values(work_orders2[0], 'a1', 'F101'),
+        ])
+        self.assertEqual(errors, [None, None, None])
+        self.assertEqual(work_orders1[0].state, 'done')
+        self.assertEqual(work_orders2[0].state, 'done')
+        self.assertEqual(work_orders1[1].state, 'pending')
+        self.assertEqual(mo.state, 'progress')
+
+        errors = self.env['mrp.production.pico.work.order'].pico_complete_batch([
+            values(work_orders2[1], 'a1', 'F102'),
+        ])
+        self.assertEqual(errors, [None])
+        self.assertEqual(set(mo.pico_work_order_ids.mapped('state')), {'done'})
+        self.assertEqual(mo.state, 'done')
+        self.assertEqual(sorted(mo.finished_move_line_ids.mapped('lot_id.name')), ['F101', 'F102'])
+        self.assertEqual(sorted(mo.move_raw_ids.mapped('move_line_ids.lot_id.name')), ['C101', 'C102'])
+
+    def test_pico_progress(self):
+        mo, process1, process2 = self._multi_process_setup(product_qty=2.0)
+        self._patch_unique_work_order_ids()
+        mo.action_confirm()
+
+        def counts():
+            return {progress.process_id: (progress.running_count, progress.pending_count, progress.done_count)
+                    for progress in mo.pico_progress_ids}
+
+        self.assertEqual(counts(), {process1: (2, 0, 0), process2: (2, 0, 0)})
+        work_order1 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process1)[0]
+        work_order2 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process2)[0]
+        work_order1.pico_complete({
+            'id': 'completion-C101',
+            'attributes': [{'id': 'a2', 'label': 'A2', 'value': 'C101'}],
+            'workOrderId': work_order1.pico_id,
+        })
+        self.assertEqual(counts(), {process1: (1, 1, 0), process2: (2, 0, 0)})
+        work_order2.pico_complete({
+            'id': 'completion-F101',
+            'attributes': [{'id': 'a1', 'label': 'A1', 'value': 'F101'}],
+            'workOrderId': work_order2.pico_id,
+        })
+        self.assertEqual(counts(), {process1: (1, 0, 1), process2: (1, 0, 1)})
+
+        # deleted work orders are no longer counted
+        mo.pico_work_order_ids.filtered(lambda w: w.state == 'running').unlink()
+        self.assertEqual(counts(), {process1: (0, 0, 1), process2: (0, 0, 1)})
+
+    def test_pico_progress_recompute(self):
+        mo, process1, process2 = self._multi_process_setup(product_qty=2.0)
+        self._patch_unique_work_order_ids()
+        mo.action_confirm()
+        progress_model = self.env['mrp.production.pico.progress']
+
+        def counts():
+            return {progress.process_id: (progress.running_count, progress.pending_count, progress.done_count)
+                    for progress in mo.pico_progress_ids}
+
+        work_order1 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process1)[0]
+        work_order2 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process2)[0]
+        work_order1.pico_complete({
+            'id': 'completion-C101',
+            'attributes': [{'id': 'a2', 'label': 'A2', 'value': 'C101'}],
+            'workOrderId': work_order1.pico_id,
+        })
+        # counters lost (e.g. created before the backfill ran)
+        self.cr.execute('DELETE FROM mrp_production_pico_progress WHERE production_id = %s', [mo.id])
+        mo.invalidate_cache(['pico_progress_ids'])
+        self.assertEqual(counts(), {})
+
+        # never below zero
+        progress_model._pico_apply(Counter({(mo.id, process1.id, 'running'): 1}), Counter())
+        self.assertEqual(counts(), {process1: (0, 0, 0)})
+
+        # the counters say process1 has nothing pending, the work orders are counted and the set completed
+        work_order2.pico_complete({
+            'id': 'completion-F101',
+            'attributes': [{'id': 'a1', 'label': 'A1', 'value': 'F101'}],
+            'workOrderId': work_order2.pico_id,
+        })
+        self.assertEqual(work_order1.state, 'done')
+        self.assertEqual(work_order2.state, 'done')
+        self.assertEqual(counts(), {process1: (1, 0, 1), process2: (1, 0, 1)})
+
+    def test_find_or_create_serials(self):
+        mo = self.env['mrp.production'].browse()
+        component = self.product.bom_ids.bom_line_ids.product_id
+        existing = self.env['stock.production.lot'].create({
+            'product_id': self.product.id,
+            'name': 'F101',
+            'company_id': self.env.user.company_id.id,
+        })
+        serials = mo._pico_find_or_create_serials([
+            (self.product, 'F101'),
+            (self.product, 'F102'),
+            (component, 'F101'),
+            (self.product, 'F102'),
+        ])
+        self.assertEqual(len(serials), 3)
+        self.assertEqual(serials[(self.product.id, 'F101')], existing)
+        self.assertEqual(serials[(self.product.id, 'F102')].product_id, self.product)
+        self.assertEqual(serials[(component.id, 'F101')].product_id, component)
+        self.assertEqual(mo._pico_find_or_create_serial(self.product, 'F102'), serials[(self.product.id, 'F102')])
+
+    def test_split_lines_values_by_lot(self):
+        component = self.product.bom_ids.bom_line_ids.product_id
+        lot1, lot2 = self.env['mrp.production']._pico_find_or_create_serials([
+            (component, 'C101'), (component, 'C102')]).values()
+        move = self.env['stock.move'].new({'product_uom': self.env.ref('uom.product_uom_unit').id})
+        lines_values = [
+            {'product_id': component.id, 'lot_id': lot1.id, 'qty_to_consume': 0.5, 'qty_reserved': 0.5, 'qty_done': 0.5},
+            {'product_id': component.id, 'lot_id': False, 'qty_to_consume': 0.5, 'qty_reserved': 0.0, 'qty_done': 0.5},
+        ]
+        split_values = self.env['mrp.product.produce']._split_lines_values_by_lot(
+            move, lines_values, 1.0, [lot1, lot2, lot1])
+        self.assertEqual([(v['lot_id'], v['qty_to_consume'], v['qty_done'], v['qty_reserved']) for v in split_values], [
+            (lot1.id, 0.67, 0.67, 0.5),
+            (lot2.id, 0.33, 0.33, 0.0),
+        ])
+
+    def test_sync_data_incremental_validation(self):
+        response_data = {
+            "id": "v12",
+            "workflow": {
+                "id": "w156",
+                "name": "Test Flow",
+                "processes": [{
+                    "id": "p18",
+                    "name": "test process",
+                    'attrs': [
+                        {'id': 'a101', 'label': 'A 101'},
+                        {'id': 'a102', 'label': 'A 102'},
+                    ],
+                    'produced_attr_id': 'a101',
+                    'consumed_attr_ids': ['a102'],
+                }]
+            }
+        }
+        workflow = self.env['pico.workflow'].process_pico_data(response_data)
+        self._product_add_workflow(workflow)
+        # invalid, but nothing has told us yet
+        self.product.bom_ids.bom_line_ids.write({'pico_attr_id': False})
+        self.assertFalse(self._new_workflow_activities(workflow))
+
+        # only labels changed, BoMs are not re-validated
+        response_data['workflow']['processes'][0]['name'] = 'renamed process'
+        response_data['workflow']['processes'][0]['attrs'][1]['label'] = 'renamed attr'
+        self.env['pico.workflow'].process_pico_data(response_data)
+        self.assertEqual(workflow.process_ids.name, 'renamed process')
+        self.assertFalse(self._new_workflow_activities(workflow))
+
+        # a new consumed attr on the BoM's process re-validates it
+        response_data['workflow']['processes'][0]['attrs'].append({'id': 'a103', 'label': 'A 103'})
+        response_data['workflow']['processes'][0]['consumed_attr_ids'].append('a103')
+        self.env['pico.workflow'].process_pico_data(response_data)
+        self.assertTrue(self._new_workflow_activities(workflow))
+
+    def test_sync_data_fingerprint(self):
+        response_data = {
+            "id": "v12",
+            "workflow": {
+                "id": "w156",
+                "name": "Test Flow",
+                "processes": [{'id': 'p18', 'name': 'P 18'}, {'id': 'p19', 'name': 'P 19'}],
+            }
+        }
+        workflow = self.env['pico.workflow'].process_pico_data(response_data)
+        self.assertTrue(workflow.pico_payload_hash)
+        p18 = workflow.process_ids.filtered(lambda p: p.pico_id == 'p18')
+        p19 = workflow.process_ids.filtered(lambda p: p.pico_id == 'p19')
+
+        # an identical delivery is skipped entirely
+        p18.name = 'Renamed Locally'
+        self.assertEqual(self.env['pico.workflow'].process_pico_data(response_data), workflow)
+        self.assertEqual(p18.name, 'Renamed Locally')
+
+        diff = workflow._pico_payload_diff({
+            "id": "v13",
+            "workflow": {
+                "id": "w156",
+                "name": "Test Flow",
+                "processes": [{'id': 'p18', 'name': 'P 18'}, {'id': 'p20'}],
+            }
+        })
+        self.assertEqual(diff, {'name': False, 'version': True, 'process_ids': {'p19', 'p20'}})
+
+        # only the changed process is written
+        response_data['workflow']['processes'][1]['name'] = 'P 19 Renamed'
+        self.env['pico.workflow'].process_pico_data(response_data)
+        self.assertEqual(p19.name, 'P 19 Renamed')
+        self.assertEqual(p18.name, 'Renamed Locally')
+
+    def test_sync_data_large_workflow(self):
+        def process_data(i):
+            attrs = [{'id': 'p%d-a%d' % (i, j), 'label': 'A %d' % (j, )} for j in range(10)]
+            process = {'id': 'p%d' % (i, ), 'name': 'P %d' % (i, ), 'attrs': attrs, 'consumed_attr_ids': [attrs[1]['id']]}
+            if i % 10 == 9:
+                process['produced_attr_id'] = attrs[0]['id']
+            return process
+
+        response_data = {
+            "id": "v12",
+            "workflow": {
+                "id": "w156",
+                "name": "Test Flow",
+                "processes": [process_data(i) for i in range(200)],
+            }
+        }
+        workflow = self.env['pico.workflow'].process_pico_data(response_data)
+        self.assertEqual(len(workflow.process_ids), 200)
+        self.assertEqual(len(workflow.process_ids.mapped('attr_ids')), 2000)
+
+        # everything moves down a sequence and producing processes shift
+        response_data['workflow']['processes'].insert(0, process_data(200))
+        response_data['workflow']['processes'][-1].pop('produced_attr_id')
+        # timed in test_pico_benchmark, a query per attr would be over 2,000
+        query_count = self.cr.sql_log_count
+        self.env['pico.workflow'].process_pico_data(response_data)
+        workflow.flush()
+        self.assertLess(self.cr.sql_log_count - query_count, 1000)
+
+        processes = {p.pico_id: p for p in workflow.process_ids}
+        self.assertEqual(len(processes), 201)
+        self.assertEqual(processes['p200'].sequence, 1)
+        self.assertEqual(processes['p0'].sequence, 2)
+        self.assertEqual(processes['p200'].producing_process_id, processes['p9'])
+        self.assertEqual(processes['p0'].producing_process_id, processes['p9'])
+        self.assertFalse(processes['p9'].producing_process_id)
+        self.assertFalse(processes['p190'].producing_process_id)
+        self.assertFalse(processes['p199'].producing_process_id)
+        self.assertEqual(processes['p199'].attr_ids.filtered(lambda a: a.type == 'consume').pico_id, 'p199-a1')
+        self.assertFalse(processes['p199'].attr_ids.filtered(lambda a: a.type == 'produce'))
+
+    def test_dispatcher(self):
+        running = []
+        in_flight = []
+        lock = threading.Lock()
+
+        def call(i):
+            with lock:
+                running.append(i)
+                in_flight.append(len(running))
+            sleep(0.01)
+            with lock:
+                running.remove(i)
+            if i == 3:
+                raise ValueError('call failed')
+            return i * 2
+
+        dispatcher = pico_requests.PicoMESDispatcher(concurrency=10)
+        results = dispatcher.map(call, [(i, ) for i in range(20)], return_exceptions=True)
+        # calls overlap, at most 10 at a time
+        self.assertGreater(max(in_flight), 1)
+        self.assertLessEqual(max(in_flight), 10)
+        self.assertEqual(results[:3], [0, 2, 4])
+        self.assertIsInstance(results[3], ValueError)
+        self.assertEqual(results[4:], [i * 2 for i in range(4, 20)])
+        with self.assertRaises(ValueError):
+            dispatcher.map(call, [(i, ) for i in range(5)])
+        self.assertEqual(pico_requests.PicoMESDispatcher(concurrency=1).map(call, [(1, ), (2, )]), [2, 4])
+
+    def test_mrp_circuit_open(self):
+        mo, process1, process2 = self._multi_process_setup()
+        breaker = pico_api(self.env).breaker
+        self.addCleanup(breaker.reset)
+        for i in range(breaker.failure_threshold):
+            breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+
+        # Pico is down, the work orders are deferred instead of failing the confirmation
+        mo.action_confirm()
+        self.assertEqual(mo.state, 'confirmed')
+        self.assertEqual(len(mo.pico_work_order_ids), 2)
+        self.assertEqual(set(mo.pico_work_order_ids.mapped('state')), {'draft'})
+        outbox = self.env['pico.outbox'].search([('work_order_id', 'in', mo.pico_work_order_ids.ids)])
+        self.assertEqual(len(outbox), 2)
+
+        # flushing waits for Pico without using up attempts
+        self.env['pico.outbox']._cron_flush()
+        self.assertEqual(outbox.mapped('attempts'), [0, 0])
+
+        breaker.reset()
+        self.env['pico.outbox']._cron_flush()
+        self.assertFalse(outbox.exists())
+        self.assertEqual(set(mo.pico_work_order_ids.mapped('state')), {'running'})
+
+    def test_mrp_circuit_open_mid_batch(self):
+        mo, process1, process2 = self._multi_process_setup()
+        original_create_work_order = pico_requests.PicoMESRequest.create_work_order
+
+        def create_work_order(api, process_id, workflow_version_id, annotation=''):
+            # the shared breaker opened while the batch was being sent
+            if process_id == process2.pico_id:
+                raise PicoCircuitOpen('Pico circuit breaker is open')
+            return {'id': 'wo-' + process_id}
+
+        pico_requests.PicoMESRequest.create_work_order = create_work_order
+        try:
+            mo.action_confirm()
+        finally:
+            pico_requests.PicoMESRequest.create_work_order = original_create_work_order
+
+        # only the work order that was not sent is deferred, the created one keeps its id
+        work_order1 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process1)
+        work_order2 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process2)
+        self.assertEqual(work_order1.state, 'running')
+        self.assertEqual(work_order1.pico_id, 'wo-' + process1.pico_id)
+        self.assertEqual(work_order2.state, 'draft')
+        outbox = self.env['pico.outbox'].search([('work_order_id', 'in', mo.pico_work_order_ids.ids)])
+        self.assertEqual(outbox.work_order_id, work_order2)
+
+    def test_settings_circuit_state(self):
+        self.env['ir.config_parameter'].sudo().set_param('pico.url', False)
+        settings = self.env['res.config.settings'].new({'pico_url': 'http://new-test:9000'})
+        self.assertEqual(settings.pico_circuit_state, 'closed')
+
+    def test_mrp_release_window(self):
+        mo, process1, process2 = self._multi_process_setup(product_qty=3.0)
+        self._patch_unique_work_order_ids()
+        mo.bom_id.pico_release_window = 1
+        mo.action_confirm()
+        # only one unit is open in Pico
+        self.assertEqual(mo.pico_released_qty, 1)
+        self.assertEqual(len(mo.pico_work_order_ids), 2)
+
+        def complete_set():
+            work_orders = mo.pico_work_order_ids.filtered(lambda w: w.state == 'running')
+            wo1 = work_orders.filtered(lambda w: w.process_id == process1)
+            wo2 = work_orders.filtered(lambda w: w.process_id == process2)
+            errors = self.env['mrp.production.pico.work.order'].pico_complete_batch([{
+                'id': 'completion-' + wo.pico_id,
+                'attributes': [{'id': attr_id, 'label': attr_id.upper(), 'value': 'S' + wo.pico_id}],
+                'workOrderId': wo.pico_id,
+            } for wo, attr_id in ((wo1, 'a2'), (wo2, 'a1'))])
+            self.assertEqual(errors, [None, None])
+
+        # completing the open unit releases the next one
+        complete_set()
+        self.assertEqual(mo.pico_released_qty, 2)
+        self.assertEqual(len(mo.pico_work_order_ids), 4)
+        self.assertEqual(len(mo.pico_work_order_ids.filtered(lambda w: w.state == 'running')), 2)
+
+        # cancelling only has to delete the open window
+        deleted = []
+        original_delete_work_orders = pico_requests.PicoMESRequest.delete_work_orders
+
+        def delete_work_orders(api, work_order_ids, return_exceptions=False):
+            deleted.extend(work_order_ids)
+            return [None for _id in work_order_ids]
+
+        pico_requests.PicoMESRequest.delete_work_orders = delete_work_orders
+        try:
+            mo.action_cancel()
+        finally:
+            pico_requests.PicoMESRequest.delete_work_orders = original_delete_work_orders
+        self.assertEqual(len(deleted), 2)
+        self.assertEqual(len(mo.pico_work_order_ids), 2)
+        self.assertEqual(set(mo.pico_work_order_ids.mapped('state')), {'done'})
+
+    def test_compact_attr_values(self):
+        self.env['ir.config_parameter'].sudo().set_param('pico.attr.compact', True)
+        mo, workflow = self.mrp_setup()
+        work_order = mo.pico_work_order_ids
+        values = {
+            'id': 'completion-00000001',
+            'attributes': [
+                {'id': 'a1', 'label': 'A1', 'value': 'F101'},
+                {'id': 'a2', 'label': 'A2', 'value': 'C101'},
+            ],
+            'workOrderId': work_order.pico_id,
+        }
+        work_order.pico_complete(values)
+        self.assertEqual(work_order.state, 'done')
+        self.assertEqual(mo.state, 'done')
+        self.assertFalse(work_order.attr_value_ids)
+        self.assertEqual(work_order.find_finished_serial(), 'F101')
+        self.assertEqual(work_order.find_consumed_serial(self.product.bom_ids.bom_line_ids), 'C101')
+        self.assertEqual(mo.finished_move_line_ids.lot_id.name, 'F101')
+        attr_a2 = workflow.process_ids.attr_ids.filtered(lambda a: a.pico_id == 'a2')
+        self.assertEqual(work_order._pico_search_attr_value(attr_a2, 'C101'), work_order)
+        self.assertFalse(work_order._pico_search_attr_value(attr_a2, 'C102'))
+
+        # a re-delivery replaces the values
+        values['attributes'][1]['value'] = 'C102'
+        work_order.pico_complete(values)
+        self.assertEqual(work_order.find_consumed_serial(self.product.bom_ids.bom_line_ids), 'C102')
+        self.assertEqual(work_order._pico_search_attr_value(attr_a2, 'C102'), work_order)
+
+        # values of an attr dropped from the process by a later sync are still found, like with rows
+        workflow.process_ids.write({'attr_ids': [(3, attr_a2.id, 0)]})
+        self.assertFalse(attr_a2.process_id)
+        self.assertEqual(work_order.find_consumed_serial(self.product.bom_ids.bom_line_ids), 'C102')
+        self.assertEqual(work_order._pico_search_attr_value(attr_a2, 'C102'), work_order)
+        workflow.process_ids.write({'attr_ids': [(4, attr_a2.id, 0)]})
+
+        # attr value rows are moved into the compact column
+        old_work_order = work_order.copy({'pico_id': False, 'attr_value_ids': [(0, 0, {
+            'attr_id': attr_a2.id,
+            'value': 'C100',
+        })]})
+        self.assertEqual(old_work_order._pico_search_attr_value(attr_a2, 'C100'), old_work_order)
+        work_order._pico_migrate_attr_values()
+        self.assertFalse(old_work_order.attr_value_ids)
+        self.assertEqual(old_work_order.find_consumed_serial(self.product.bom_ids.bom_line_ids), 'C100')
+        self.assertEqual(old_work_order._pico_search_attr_value(attr_a2, 'C100'), old_work_order)
+
+    def test_attr_index(self):
+        mo, workflow = self.mrp_setup()
+        work_order = mo.pico_work_order_ids
+        work_order.pico_complete({
+            'id': 'completion-00000001',
+            'attributes': [
+                {'id': 'a1', 'label': 'A1', 'value': 'F101'},
+                {'id': 'a2', 'label': 'A2', 'value': 'C101'},
+            ],
+            'workOrderId': work_order.pico_id,
+        })
+        attrs = workflow.process_ids.attr_ids
+        attr_a1 = attrs.filtered(lambda a: a.pico_id == 'a1')
+        attr_a2 = attrs.filtered(lambda a: a.pico_id == 'a2')
+        index = work_order._pico_attr_index()
+        self.assertEqual(index[attr_a1.id], 'F101')
+        self.assertEqual(index[attr_a2.id], 'C101')
+        self.assertEqual(index['produce'], 'F101')
+        self.assertEqual(work_order.find_finished_serial(index), 'F101')
+        self.assertEqual(work_order.find_consumed_serial(self.product.bom_ids.bom_line_ids, index), 'C101')
+
+        # the index is what gets looked up, not the work orders
+        self.assertEqual(work_order.find_finished_serial({'produce': 'F102'}), 'F102')
+        self.assertIsNone(work_order.find_consumed_serial(self.product.bom_ids.bom_line_ids, {}))
+
+    def test_work_order_archive(self):
+        mo, _ = self.mrp_setup()
+        work_order = mo.pico_work_order_ids
+        work_order.pico_complete({
+            'id': 'completion-00000001',
+            'attributes': [
+                {'id': 'a1', 'label': 'A1', 'value': 'F101'},
+                {'id': 'a2', 'label': 'A2', 'value': 'C101'},
+            ],
+            'completedAt': '2020-10-02T10:40:50.043Z',
+            'cycleTime': 120,
+            'workOrderId': work_order.pico_id,
+        })
+        self.assertEqual(mo.state, 'done')
+        pico_id = work_order.pico_id
+        archive = self.env['mrp.production.pico.work.order.archive']
+
+        # an attr without a pico_id is archived too
+        local_attr = self.env['pico.workflow.process.attr'].create({
+            'name': 'Local',
+            'process_id': work_order.process_id.id,
+        })
+        work_order.write({'attr_value_ids': [(0, 0, {'attr_id': local_attr.id, 'value': 'L1'})]})
+
+        # nothing is archived without a retention
+        archive._cron_archive()
+        self.assertTrue(work_order.exists())
+
+        self.env['ir.config_parameter'].sudo().set_param('pico.work_order.retention_days', 30)
+        archive._cron_archive(batch_size=1)
+        self.assertFalse(work_order.exists())
+        self.assertFalse(mo.pico_work_order_ids)
+        archived = archive.search([('production_id', '=', mo.id)])
+        self.assertEqual(archived.pico_id, pico_id)
+        self.assertEqual(archived.cycle_time, 120)
+        self.assertEqual(loads(archived.attr_values), {
+            'a1': 'F101',
+            'a2': 'C101',
+            'attr:%s' % (local_attr.id, ): 'L1',
+        })
+        self.assertEqual(mo.pico_archived_count, 1)
+        self.assertEqual(mo.pico_archived_cycle_time, 120)
+        self.assertEqual(mo.pico_archived_date_complete, datetime(2020, 10, 2, 10, 40, 50))
+
+    def test_process_graph_sync(self):
+        def process(pico_id, produces=False):
+            values = {'id': pico_id, 'name': pico_id, 'attrs': [{'id': pico_id + '-a', 'label': 'A'}]}
+            if produces:
+                values['produced_attr_id'] = pico_id + '-a'
+            return values
+
+        def graph(workflow):
+            return {p.pico_id: set(p.process_ids.mapped('pico_id')) for p in workflow.process_ids}
+
+        response_data = {
+            'id': 'v12',
+            'workflow': {
+                'id': 'w156',
+                'name': 'Test Flow',
+                'processes': [process('p1'), process('p2', True), process('p3'), process('p4', True)],
+            },
+        }
+        workflow = self.env['pico.workflow'].process_pico_data(response_data)
+        self.assertEqual(graph(workflow), {'p1': {'p1'}, 'p2': {'p1', 'p2'}, 'p3': {'p3'}, 'p4': {'p3', 'p4'}})
+        # stored, not computed on read
+        self.env.cr.execute("""
+            SELECT count(*) FROM pico_workflow_process_graph_rel r
+            JOIN pico_workflow_process p ON p.id = r.process_id
+            WHERE p.workflow_id = %s
+        """, [workflow.id])
+        self.assertEqual(self.env.cr.fetchone()[0], 6)
+
+        # p3 moves into p2, p4 no longer has any process producing into it
+        response_data['workflow']['processes'] = [process('p1'), process('p3'), process('p2', True), process('p4', True)]
+        workflow = self.env['pico.workflow'].process_pico_data(response_data)
+        self.assertEqual(graph(workflow), {'p1': {'p1'}, 'p2': {'p1', 'p2', 'p3'}, 'p3': {'p3'}, 'p4': {'p4'}})
+
+        # archived processes leave the graph
+        response_data['workflow']['processes'] = [process('p3'), process('p2', True), process('p4', True)]
+        workflow = self.env['pico.workflow'].process_pico_data(response_data)
+        self.assertEqual(graph(workflow), {'p2': {'p2', 'p3'}, 'p3': {'p3'}, 'p4': {'p4'}})
+
+    def test_reconcile(self):
+        mo, process1, process2 = self._multi_process_setup()
+        self._patch_unique_work_order_ids()
+        mo.action_confirm()
+        work_order1 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process1)
+        work_order2 = mo.pico_work_order_ids.filtered(lambda w: w.process_id == process2)
+        pico_work_orders = {wo.pico_id: {'id': wo.pico_id} for wo in mo.pico_work_order_ids}
+
+        class PicoStatusStandIn(PicoStandIn):
+            def respond(self, method, path, body):
+                path, _, query = path.partition('?')
+                if query:
+                    return {'workOrders': [pico_work_orders[i] for i in parse_qs(query)['ids'][0].split(',')]}
+                return pico_work_orders[path.split('/')[-1]]
+
+        stand_in = PicoStatusStandIn()
+        self.addCleanup(stand_in.stop)
+        self.addCleanup(lambda: pico_requests._breakers.pop(stand_in.url, None))
+        self.env['ir.config_parameter'].sudo().set_param('pico.url', stand_in.url)
+        model = self.env['mrp.production.pico.work.order']
+
+        # work orders written recently are left alone
+        model._cron_reconcile()
+        self.assertFalse(stand_in.calls)
+
+        model.flush()
+        self.env.cr.execute("""
+            UPDATE mrp_production_pico_work_order SET write_date = write_date - interval '1 hour' WHERE id IN %s
+        """, [tuple(mo.pico_work_order_ids.ids)])
+        model.invalidate_cache()
+        pico_work_orders[work_order1.pico_id].update({
+            'completedAt': '2020-10-02T10:40:50.043Z',
+            'attributes': [{'id': 'a2', 'label': 'A2', 'value': 'C101'}],
+        })
+        model._cron_reconcile()
+        self.assertEqual(sorted(call[1] for call in stand_in.calls),
+                         sorted('/work_orders/' + wo.pico_id for wo in mo.pico_work_order_ids))
+        self.assertEqual(work_order1.state, 'pending')
+        self.assertEqual(work_order2.state, 'running')
+
+        # with the batch endpoint, one request per page
+        self.env['ir.config_parameter'].sudo().set_param('pico.batch.endpoint', True)
+        stand_in.calls.clear()
+        pico_work_orders[work_order2.pico_id].update({
+            'completedAt': '2020-10-02T10:41:50.043Z',
+            'attributes': [{'id': 'a1', 'label': 'A1', 'value': 'F101'}],
+        })
+        model._cron_reconcile()
+        self.assertEqual([call[1] for call in stand_in.calls], ['/work_orders?ids=' + work_order2.pico_id])
+        self.assertEqual(set(mo.pico_work_order_ids.mapped('state')), {'done'})
+        self.assertEqual(mo.state, 'done')
+        self.assertEqual(mo.finished_move_line_ids.lot_id.name, 'F101')
+
+    def test_production_lock(self):
+        def try_lock(production_id):
+            self.env.cr.execute('SELECT pg_try_advisory_lock(%s, %s)', [PICO_PRODUCTION_LOCK, production_id])
+            locked = self.env.cr.fetchone()[0]
+            if locked:
+                unlock_productions(self.env.cr, [production_id])
+            return locked
+
+        with self.registry.cursor() as cr:
+            self.assertEqual(lock_productions(cr, [7, 3, 7]), [3, 7])
+            # already held by this connection
+            self.assertEqual(lock_productions(cr, [3, 5]), [5])
+            self.assertFalse(try_lock(3))
+            self.assertFalse(try_lock(5))
+            # held by another connection
+            self.assertEqual(try_lock_productions(self.env.cr, [5, 9]), ([9], [5]))
+            unlock_productions(self.env.cr, [9])
+            unlock_productions(cr, [3, 5, 7])
+        self.assertTrue(try_lock(3))
+        self.assertTrue(try_lock(7))
+
+    def test_production_lock_for_transaction(self):
+        delivery_hash = 'test-production-lock'
+        try:
+            with self.registry.cursor() as cr1, self.registry.cursor() as cr2:
+                delivery1 = api.Environment(cr1, SUPERUSER_ID, {})['pico.webhook.delivery']
+                delivery2 = api.Environment(cr2, SUPERUSER_ID, {})['pico.webhook.delivery']
+                self.assertFalse(delivery1._is_processed(1, delivery_hash))
+                # another delivery holding the lock commits after the snapshot of cr1
+                self.assertEqual(lock_productions(cr2, [3]), [3])
+                delivery2._mark_processed(1, delivery_hash)
+                cr2.commit()
+                self.assertFalse(delivery1._is_processed(1, delivery_hash))
+                unlock_productions(cr2, [3])
+                # the lock restarts the transaction, the other delivery is seen
+                self.assertEqual(lock_productions_for_transaction(cr1, [3, 5]), [3, 5])
+                self.assertTrue(delivery1._is_processed(1, delivery_hash))
+                # held until the transaction ends, a queue worker skips the production meanwhile
+                self.assertEqual(try_lock_productions(cr2, [3, 5]), ([], [3, 5]))
+                cr1.commit()
+                self.assertEqual(held_production_locks(cr1), [])
+                self.assertEqual(try_lock_productions(cr2, [3, 5]), ([3, 5], []))
+                unlock_productions(cr2, [3, 5])
+        finally:
+            with self.registry.cursor() as cr:
+                cr.execute('DELETE FROM pico_webhook_delivery WHERE payload_hash = %s', [delivery_hash])
+
+    def test_webhook_queue_partitions(self):
+        with self.registry.cursor() as cr:
+            queue = api.Environment(cr, SUPERUSER_ID, {})['pico.webhook.queue']
+            entries = queue.create([{
+                'method': 'workOrderCompleteMethod',
+                'payload': '{}',
+                'ordering_key': 'test-partition:%s' % (key, ),
+            } for key in (1, 1, 2, 2, 3)])
+            entry_ids = entries.ids
+        try:
+            with self.registry.cursor() as cr1, self.registry.cursor() as cr2:
+                queue1 = api.Environment(cr1, SUPERUSER_ID, {})['pico.webhook.queue']
+                queue2 = api.Environment(cr2, SUPERUSER_ID, {})['pico.webhook.queue']
+                # partitions 1 and 2 are claimed, partition 2 beyond the batch size stays held
+                claimed1 = queue1._claim(2)
+                self.assertEqual(claimed1.ids, entry_ids[:2])
+                claimed2 = queue2._claim(10)
+                self.assertEqual(claimed2.ids, entry_ids[4:])
+                cr1.rollback()
+                cr2.rollback()
+                # a partition being retried is skipped for the rest of the run
+                claimed1 = queue1._claim(10, {'test-partition:1'})
+                self.assertEqual(claimed1.ids, entry_ids[2:])
+                cr1.rollback()
+        finally:
+            with self.registry.cursor() as cr:
+                cr.execute('DELETE FROM pico_webhook_queue WHERE id IN %s', [tuple(entry_ids)])
+
+    def test_webhook_queue_budget(self):
+        budget = WorkerBudget(5)
+        self.assertEqual(budget.take(3), 3)
+        self.assertEqual(budget.take(3), 2)
+        self.assertEqual(budget.take(3), 0)
+        budget.give_back(1)
+        self.assertEqual(budget.take(3), 1)
+
+        queue = self.env['pico.webhook.queue']
+        queue.search([]).unlink()
+        entries = queue.create([{
+            'method': 'workOrderCompleteMethod',
+            'payload': dumps({'partition': p}),
+            'ordering_key': 'production:%s' % (p, ),
+        } for p in range(5)])
+        webhook_class = type(self.env['pico.webhook'])
+        with patch.object(webhook_class, '_dispatch_once', lambda webhook, method, data, rpc_id=None: None):
+            self.assertEqual(queue._cron_process(limit=3, batch_size=2), 3)
+        self.assertEqual(entries.exists(), entries[3:])
+
+    def test_webhook_queue_throughput(self):
+        queue = self.env['pico.webhook.queue']
+        queue.search([]).unlink()
+        partitions, per_partition = 100, 20
+        queue.create([{
+            'method': 'workOrderCompleteMethod',
+            'payload': dumps({'partition': p, 'seq': i}),
+            'ordering_key': 'production:%s' % (p, ),
+        } for i in range(per_partition) for p in range(partitions)])
+
+        processed = []
+        webhook_class = type(self.env['pico.webhook'])
+        original_dispatch_once = webhook_class._dispatch_once
+
+        def dispatch_once(webhook, method, data, rpc_id=None):
+            processed.append((data['partition'], data['seq']))
+
+        claims = []
+        original_claim = type(queue)._claim
+
+        def claim(queue, batch_size, skip_keys=()):
+            entries = original_claim(queue, batch_size, skip_keys)
+            claims.append(len(entries))
+            return entries
+
+        webhook_class._dispatch_once = dispatch_once
+        try:
+            # timed in test_pico_benchmark
+            with patch.object(type(queue), '_claim', claim):
+                queue._cron_process(limit=10000, batch_size=200)
+        finally:
+            webhook_class._dispatch_once = original_dispatch_once
+        self.assertEqual(len(processed), partitions * per_partition)
+        # full batches, then the empty claim that ends the run
+        self.assertEqual(claims, [200] * 10 + [0])
+        self.assertFalse(queue.search([]))
+        # every partition is processed in order
+        for p in range(partitions):
+            self.assertEqual([seq for partition, seq in processed if partition == p], list(range(per_partition)))
+
+    def test_mrp_multi_unit_produce(self):
+        self.product.tracking = 'lot'
+        mo, process1, process2 = self._multi_process_setup(product_qty=3.0)
+        self._patch_unique_work_order_ids()
+        mo.action_confirm()
+        completions = []
+        for i, wo in enumerate(mo.pico_work_order_ids.filtered(lambda w: w.process_id == process1)):
+            completions.append({
+                'id': 'completion-c%s' % (i, ),
+                'attributes': [{'id': 'a2', 'label': 'A2', 'value': 'C10%s' % (i, )}],
+                'workOrderId': wo.pico_id,
+            })
+        for i, wo in enumerate(mo.pico_work_order_ids.filtered(lambda w: w.process_id == process2)):
+            completions.append({
+                'id': 'completion-f%s' % (i, ),
+                'attributes': [{'id': 'a1', 'label': 'A1', 'value': 'F100'}],
+                'workOrderId': wo.pico_id,
+            })
+        errors = self.env['mrp.production.pico.work.order'].pico_complete_batch(completions)
+        self.assertEqual(errors, [None] * 6)
+        # the three units sharing a finished lot are produced in a single wizard run
+        self.assertEqual(self.env['mrp.product.produce'].search_count([('production_id', '=', mo.id)]), 1)
+        self.assertEqual(set(mo.pico_work_order_ids.mapped('state')), {'done'})
+        self.assertEqual(mo.state, 'done')
+        self.assertEqual(mo.finished_move_line_ids.lot_id.name, 'F100')
+        self.assertEqual(sum(mo.finished_move_line_ids.mapped('qty_done')), 3.0)
+        consumed = mo.move_raw_ids.mapped('move_line_ids')
+        self.assertEqual(sorted(consumed.mapped('lot_id.name')), ['C100', 'C101', 'C102'])
+        self.assertEqual(consumed.mapped('qty_done'), [1.0, 1.0, 1.0])
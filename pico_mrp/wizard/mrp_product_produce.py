@@ -1,4 +1,5 @@
 from odoo import models
+from odoo.tools import float_round
 
 
 class MrpProductProduce(models.TransientModel):
@@ -8,11 +9,14 @@ class MrpProductProduce(models.TransientModel):
     Copy from mrp_subcontracting
     The 'new' lines are not accessible even via manually calling onchange for producing qty.
     """
-    def _generate_produce_lines(self):
+    def _generate_produce_lines(self, consumed_lots=None):
         """ When the wizard is called in backend, the onchange that create the
         produce lines is not trigger. This method generate them and is used with
         _record_production to appropriately set the lot_produced_id and
         appropriately create raw stock move lines.
+
+        consumed_lots optionally maps a move id to the lot consumed by each unit produced,
+        the move's quantity is then split in one line per lot.
         """
         line_values = []
         for wizard in self:
@@ -22,5 +26,37 @@ class MrpProductProduce(models.TransientModel):
             for move in moves:
                 qty_to_consume = wizard._prepare_component_quantity(move, wizard.qty_producing)
                 vals = wizard._generate_lines_values(move, qty_to_consume)
+                lots = consumed_lots and consumed_lots.get(move.id)
+                if lots and vals:
+                    vals = wizard._split_lines_values_by_lot(move, vals, qty_to_consume, lots)
                 line_values += vals
         self.env['mrp.product.produce.line'].create(line_values)
+
+    def _split_lines_values_by_lot(self, move, lines_values, qty_to_consume, lots):
+        """
+        Replaces the lines values of move (see _generate_lines_values()) by one line per lot, lots having the
+        lot of each unit produced. Each lot's share is rounded to the move's UoM, the last lot taking the remainder,
+        and keeps what the lines values had reserved of that lot.
+        """
+        rounding = move.product_uom.rounding
+        reserved_by_lot = {}
+        for values in lines_values:
+            if values.get('lot_id'):
+                reserved_by_lot[values['lot_id']] = reserved_by_lot.get(values['lot_id'], 0.0) + \
+                    values.get('qty_reserved', 0.0)
+        units_by_lot = {}
+        for lot in lots:
+            units_by_lot[lot] = units_by_lot.get(lot, 0) + 1
+        split_values = []
+        remaining_qty = qty_to_consume
+        for i, (lot, units) in enumerate(units_by_lot.items()):
+            if i == len(units_by_lot) - 1:
+                qty = float_round(remaining_qty, precision_rounding=rounding)
+            else:
+                qty = float_round(qty_to_consume * units / len(lots), precision_rounding=rounding)
+            remaining_qty -= qty
+            lot_values = dict(lines_values[0], lot_id=lot.id, qty_to_consume=qty, qty_done=qty)
+            if 'qty_reserved' in lot_values:
+                lot_values['qty_reserved'] = reserved_by_lot.get(lot.id, 0.0)
+            split_values.append(lot_values)
+        return split_values